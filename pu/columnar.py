@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+"""按列读取查询结果"""
+
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# mysql 协议的字段类型 -> array typecode
+MYSQL_TYPECODES = {
+    1: 'l',  # TINY
+    2: 'l',  # SHORT
+    3: 'l',  # LONG
+    8: 'l',  # LONGLONG
+    9: 'l',  # INT24
+    13: 'l',  # YEAR
+    4: 'd',  # FLOAT
+    5: 'd',  # DOUBLE
+}
+
+NAN = float('nan')
+
+
+def guess_typecode(values):
+    """没有类型信息时(如 sqlite)按第一个非 None 的值猜测
+    """
+    for value in values:
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            return None
+        if isinstance(value, (int, long)):
+            return 'l'
+        if isinstance(value, float):
+            return 'd'
+        return None
+    return None
+
+
+def extend_column(column, values):
+    """把一批值追加到列, 必要时把列升级: l -> d(有 None, 用 nan 表示) -> list
+    :return: 追加后的列
+    """
+    if isinstance(column, list):
+        column.extend(values)
+        return column
+    n = len(column)
+    try:
+        column.extend(values)
+        return column
+    except (TypeError, OverflowError):
+        del column[n:]
+    if all(value is None or isinstance(value, (int, long, float)) and not isinstance(value, bool)
+           for value in values):
+        if column.typecode != 'd':
+            column = array.array('d', column)
+        column.extend(NAN if value is None else value for value in values)
+        return column
+    column = column.tolist()
+    column.extend(values)
+    return column
+
+
+def fetch_columns(cursor, batch_size=1000, typecodes=None):
+    """分批 fetchmany, 按列存入 array.array(数值列) 或 list(其它列), 不构造每行的 dict
+    :param typecodes: description 的 type_code -> array typecode, None-按值猜测
+    :return: {column name: numpy array}, 没有 numpy 时 {column name: array.array 或 list}
+    """
+    typecodes = typecodes or {}
+    names = [d[0] for d in cursor.description]
+    columns = [None] * len(names)
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            break
+        for i, values in enumerate(zip(*rows)):
+            column = columns[i]
+            if column is None:
+                typecode = typecodes.get(cursor.description[i][1]) or guess_typecode(values)
+                column = array.array(typecode) if typecode else []
+            columns[i] = extend_column(column, values)
+
+    result = {}
+    for i, name in enumerate(names):
+        column = columns[i]
+        if column is None:
+            typecode = typecodes.get(cursor.description[i][1])
+            column = array.array(typecode) if typecode else []
+        if numpy is not None:
+            if isinstance(column, array.array):
+                column = numpy.frombuffer(column, dtype=numpy.dtype(column.typecode))
+            else:
+                column = numpy.array(column, dtype=object)
+        result[name] = column
+    return result
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+from operator import itemgetter
 import binascii
 
 
@@ -30,6 +31,86 @@ class pretty_bytes(bytes):
             return str(self)
 
 
+class CompactRow(tuple):
+    """基于 tuple 的紧凑行, 支持 row.name 和 row['name'] 访问
+    : 不直接使用, 由 compact_row_class 按列名生成子类
+    : 列名和 get/keys/count/index 等方法同名时, row.name 是列的值, 方法用 _ 开头的版本(row._keys() 等)
+    """
+    __slots__ = ()
+    _fields = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, basestring):
+            key = self._index[key]
+        return tuple.__getitem__(self, key)
+
+    def __getattr__(self, name):
+        try:
+            return tuple.__getitem__(self, self._index[name])
+        except KeyError:
+            raise AttributeError(name)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def _get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def _keys(self):
+        return list(self._fields)
+
+    def _values(self):
+        return list(self)
+
+    def _items(self):
+        return zip(self._fields, self)
+
+    def _asdict(self):
+        return dict(zip(self._fields, self))
+
+    get = _get
+    keys = _keys
+    values = _values
+    items = _items
+    asdict = _asdict
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (k, v) for k, v in zip(self._fields, self)))
+
+
+_compact_row_classes = {}
+
+
+def compact_row_class(column_names):
+    """按列名生成(并缓存) CompactRow 子类, 同一组列名只生成一次
+    >>> cls = compact_row_class(['id', 'name'])
+    >>> row = cls((1, 'abc'))
+    >>> row.name, row['id'], row[0]
+    ('abc', 1, 1)
+    >>> compact_row_class(('id', 'name')) is cls
+    True
+    >>> row = compact_row_class(['count', 'keys'])((3, 'k'))
+    >>> row.count, row.keys, row._keys()
+    (3, 'k', ['count', 'keys'])
+    """
+    fields = tuple(column_names)
+    cls = _compact_row_classes.get(fields)
+    if cls is None:
+        attrs = {'__slots__': (), '_fields': fields, '_index': dict((name, i) for i, name in enumerate(fields))}
+        for i, name in enumerate(fields):
+            # 以 _ 开头的列名只能通过 row['name'] 访问, 和方法同名的列覆盖方法
+            if not name.startswith('_'):
+                attrs[name] = property(itemgetter(i))
+        cls = type('CompactRow', (CompactRow,), attrs)
+        _compact_row_classes[fields] = cls
+    return cls
+
+
 if __name__ == '__main__':
     import doctest
 
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+"""pool 的队列选择策略"""
+
+from bisect import bisect
+from itertools import count
+import hashlib
+import random
+
+
+class Dispatcher(object):
+    """队列选择策略基类, select 返回队列下标
+    : 每个队列的未完成任务数用两个 itertools.count 计数(next 是原子的), 不需要加锁
+    """
+
+    def __init__(self, n):
+        self.n = n
+        self._submitted = [count(1) for _ in xrange(n)]
+        self._done = [count(1) for _ in xrange(n)]
+        self.submitted_counts = [0] * n
+        self.done_counts = [0] * n
+
+    def select(self, key=None):
+        raise NotImplementedError
+
+    def submitted(self, i):
+        self.submitted_counts[i] = next(self._submitted[i])
+
+    def done(self, i):
+        self.done_counts[i] = next(self._done[i])
+
+    def outstanding(self, i):
+        return self.submitted_counts[i] - self.done_counts[i]
+
+
+class RoundRobin(Dispatcher):
+    def __init__(self, n):
+        Dispatcher.__init__(self, n)
+        self.counter = count()
+
+    def select(self, key=None):
+        return next(self.counter) % self.n
+
+
+class PowerOfTwoChoices(Dispatcher):
+    """随机选两个队列, 取未完成任务少的
+    """
+
+    def select(self, key=None):
+        if self.n == 1:
+            return 0
+        i, j = random.sample(xrange(self.n), 2)
+        return i if self.outstanding(i) <= self.outstanding(j) else j
+
+
+class LeastOutstanding(Dispatcher):
+    """选未完成任务最少的队列, O(n) 但不取队列的锁
+    """
+
+    def select(self, key=None):
+        return min(xrange(self.n), key=self.outstanding)
+
+
+class ConsistentHash(Dispatcher):
+    """按 key 一致性哈希, 同一个 key 总是落到同一个队列, 没有 key 时轮询
+    """
+
+    def __init__(self, n, replicas=100):
+        Dispatcher.__init__(self, n)
+        self.counter = count()
+        ring = sorted((self.hash('%d-%d' % (i, r)), i) for i in xrange(n) for r in xrange(replicas))
+        self.ring_hashes = [h for h, _ in ring]
+        self.ring_nodes = [i for _, i in ring]
+
+    @staticmethod
+    def hash(key):
+        """unicode 按 utf-8 编码, 和同内容的 str 落到同一个队列
+        """
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        elif not isinstance(key, str):
+            key = str(key)
+        return int(hashlib.md5(key).hexdigest()[:8], 16)
+
+    def select(self, key=None):
+        if key is None:
+            return next(self.counter) % self.n
+        pos = bisect(self.ring_hashes, self.hash(key)) % len(self.ring_hashes)
+        return self.ring_nodes[pos]
+
+
+DISPATCHERS = {
+    'round_robin': RoundRobin,
+    'p2c': PowerOfTwoChoices,
+    'least_outstanding': LeastOutstanding,
+    'hash': ConsistentHash,
+}
+
+
+def make_dispatcher(dispatch, n):
+    """
+    :param dispatch: None-不使用(选 qsize 最小的队列), 策略名('round_robin', 'p2c', 'least_outstanding', 'hash')
+                     或 Dispatcher 实例
+    """
+    if dispatch is None or isinstance(dispatch, Dispatcher):
+        return dispatch
+    return DISPATCHERS[dispatch](n)
@@ -1,61 +1,195 @@
 # -*- coding: utf-8 -*-
 """threading event"""
 
-from threading import Condition, Lock
+from thread import allocate_lock as Lock
+from time import sleep, time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 所有 AsyncResult 共用一把锁保护状态, 只有真正需要等待时才为等待者创建锁
+_lock = Lock()
+
+
+class Timeout(Exception):
+    pass
+
+
+def _acquire(waiter, timeout=None):
+    """带超时获取锁(python2 的 Lock.acquire 不支持超时, 和 threading.Condition.wait 一样轮询)
+    :return: 是否获取到
+    """
+    if timeout is None:
+        waiter.acquire()
+        return True
+    endtime = time() + timeout
+    delay = 0.0005
+    while True:
+        if waiter.acquire(0):
+            return True
+        remaining = endtime - time()
+        if remaining <= 0:
+            return False
+        delay = min(delay * 2, remaining, .05)
+        sleep(delay)
 
 
 class AsyncResult(object):
+    __slots__ = ('_flag', '_value', '_exception', '_timeout', '_waiters', '_callbacks')
+
     def __init__(self, timeout=None):
         """threading模块提供了Event,但是没提供future/promise模式的异步 AsyncResult
         : AsyncResult类似阻塞channel
         : Queue类似非阻塞channel
+        : 不为每个结果分配 Condition, 只有 get/wait 真正需要阻塞时才创建一把锁
         """
-        self.__cond = Condition(Lock())
-        self.__flag = False
-        self.__value = None
-        self.__timeout = timeout
-        self.__exception = None
+        self._flag = False
+        self._value = None
+        self._timeout = timeout
+        self._exception = None
+        self._waiters = None
+        self._callbacks = None
 
-    def set(self, value=None):
-        self.__cond.acquire()
+    def _fire(self):
+        with _lock:
+            self._flag = True
+            waiters, self._waiters = self._waiters, None
+            callbacks, self._callbacks = self._callbacks, None
+        if waiters:
+            for waiter in waiters:
+                waiter.release()
+        if callbacks:
+            for callback in callbacks:
+                self._call(callback)
+
+    def _call(self, callback):
         try:
-            self.__flag = True
-            self.__value = value
-            self.__cond.notify_all()
-        finally:
-            self.__cond.release()
+            callback(self)
+        except Exception:
+            logger.error('[Callback error]: %s', callback, exc_info=1)
+
+    def set(self, value=None):
+        self._value = value
+        self._fire()
 
     def set_exception(self, exception=None):
-        self.__cond.acquire()
-        try:
-            self.__flag = True
-            self.__exception = exception
-            self.__cond.notify_all()
-        finally:
-            self.__cond.release()
+        self._exception = exception
+        self._fire()
 
     def clear(self):
-        self.__cond.acquire()
-        try:
-            self.__flag = False
-        finally:
-            self.__cond.release()
+        with _lock:
+            self._flag = False
+
+    def ready(self):
+        return self._flag
+
+    def successful(self):
+        return self._flag and self._exception is None
+
+    @property
+    def exception(self):
+        return self._exception
+
+    def add_done_callback(self, callback):
+        """set/set_exception 后在设置结果的线程里调用 callback(self), 已经有结果时立即调用
+        """
+        with _lock:
+            if not self._flag:
+                if self._callbacks is None:
+                    self._callbacks = []
+                self._callbacks.append(callback)
+                return
+        self._call(callback)
+
+    def remove_done_callback(self, callback):
+        """去掉还没有被调用的 callback
+        :return: 是否去掉了
+        """
+        with _lock:
+            if self._callbacks and callback in self._callbacks:
+                self._callbacks.remove(callback)
+                return True
+        return False
+
+    def wait(self, timeout=None):
+        """
+        :return: 是否已经有结果
+        """
+        if self._flag:
+            return True
+        with _lock:
+            if self._flag:
+                return True
+            waiter = Lock()
+            waiter.acquire()
+            if self._waiters is None:
+                self._waiters = []
+            self._waiters.append(waiter)
+        if _acquire(waiter, timeout):
+            return True
+        with _lock:
+            if self._waiters and waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return self._flag
 
     def get(self, block=True, timeout=None):
-        if self.__timeout is not None:
-            timeout = self.__timeout
+        """
+        :param block: False-没有结果时立即抛出 Timeout
+        :return: 结果, set_exception 设置的异常会被抛出, 超时抛出 Timeout
+        """
+        if self._timeout is not None:
+            timeout = self._timeout
 
-        self.__cond.acquire()
-        try:
+        if not self._flag:
             if not block:
-                return self.__value
-            if self.__exception is not None:
-                raise self.__exception
-            if not self.__flag:
-                self.__cond.wait(timeout)
-            return self.__value
-        finally:
-            self.__cond.release()
+                raise Timeout('result not ready')
+            if not self.wait(timeout):
+                raise Timeout('timeout after %ss' % timeout)
+        if self._exception is not None:
+            raise self._exception
+        return self._value
+
+
+def wait_all(results, timeout=None):
+    """等待所有结果
+    :return: 是否全部完成
+    """
+    endtime = None if timeout is None else time() + timeout
+    for result in results:
+        remaining = None if endtime is None else max(endtime - time(), 0)
+        if not result.wait(remaining):
+            return False
+    return True
+
+
+def wait_any(results, timeout=None):
+    """等待任意一个结果
+    :return: 第一个完成的 AsyncResult, 超时返回 None
+    """
+    waiter = Lock()
+    waiter.acquire()
+    done = []
+
+    def callback(result):
+        with _lock:
+            done.append(result)
+            first = len(done) == 1
+        if first:
+            waiter.release()
+
+    added = []
+    for result in results:
+        result.add_done_callback(callback)
+        added.append(result)
+        if done:
+            break
+    try:
+        if _acquire(waiter, timeout):
+            return done[0]
+        return None
+    finally:
+        for result in added:  # 没有触发的 callback 不再留在其它结果上
+            result.remove_done_callback(callback)
 
 
 def test_AsyncResult():
@@ -3,81 +3,200 @@
 
 import logging
 import sys
+import time
+
+from dispatch import make_dispatcher
+from instrument import PoolMetrics, op_name
 
 logger = logging.getLogger(__name__)
 
 try:
     from gevent.event import AsyncResult
-    from gevent.queue import Queue
+    from gevent.queue import Queue, Empty
     import gevent
 except ImportError:
     logger.warn('gevent module not found. please: pip install gevent')
 
+try:
+    from tornado.concurrent import Future
+    from tornado.ioloop import IOLoop
+    from tornado import gen
+except ImportError:
+    logger.warn('tornado module not found. acall/amap need tornado')
+
+
+def to_future(async_result, io_loop=None):
+    """把 gevent AsyncResult 转成 tornado Future, 结果通过 IOLoop.add_callback(线程安全) 交给 ioloop
+    : 需要在 ioloop 线程里调用
+    """
+    io_loop = io_loop or IOLoop.current()
+    future = Future()
+
+    def resolve(result):
+        if result.successful():
+            future.set_result(result.value)
+        else:
+            future.set_exception(result.exception)
+
+    async_result.rawlink(lambda result: io_loop.add_callback(resolve, result))
+    return future
+
 
 class ConnectionPool(object):
     """每个线程/连接使用1个队列的连接池(可用在rpc客户端, 数据库客户端等)
+    : 指定 min_size 时连接数在 [min_size, n] 之间伸缩: greenlet 和队列还是 n 个, 但只往前 active 个队列派发任务,
+    : 队列积压或任务排队过久时启用下一个队列(连接在它的 greenlet 里按需创建), 最后一个活跃队列空闲超过 idle_timeout 时关闭连接
     """
 
-    def __init__(self, n, connection_cls, options={}):
+    def __init__(self, n, connection_cls, options={}, dispatch=None, min_size=None, warmup=None, idle_timeout=60,
+                 grow_qsize=2, grow_wait=0.1, metrics=False, stats_interval=None, stats_callback=None):
         """
+        :param n: 最大连接数
         :param connection_cls: 连接客户端类, 最好在 connection_cls 内部实现重连等
         :param options: 连接客户端参数
+        :param dispatch: 队列选择策略, 见 pu.dispatch.make_dispatcher, None-选 qsize 最小的队列. 伸缩模式下不能使用
+        :param min_size: 最少连接数(至少1), None-不伸缩, 启动时创建 n 个连接
+        :param warmup: 启动时创建的连接数, 默认 min_size
+        :param idle_timeout: 伸缩模式下空闲多少秒关闭连接
+        :param grow_qsize: 伸缩模式下选中的队列长度达到多少时启用新连接
+        :param grow_wait: 伸缩模式下任务排队超过多少秒时启用新连接
+        :param metrics: True-统计排队时间, 执行时间等, 见 stats()
+        :param stats_interval: 每隔多少秒把 stats() 传给 stats_callback(stats), 需要 metrics
         """
+        assert min_size is None or dispatch is None
+        self.connection_cls = connection_cls
+        self.options = options
         self.queues = []
         self.tasks = []
-        self.conns = []
+        self.conns = [None] * n
+        self.dispatcher = make_dispatcher(dispatch, n)
+        self.elastic = min_size is not None
+        self.min_size = n if min_size is None else max(min_size, 1)  # 至少保留1个活跃队列
+        self.idle_timeout = idle_timeout
+        self.grow_qsize = grow_qsize
+        self.grow_wait = grow_wait
+        self.metrics = PoolMetrics(n) if metrics else None
 
-        for _ in xrange(n):
-            c = connection_cls(**options)
-            self.conns.append(c)
+        warmup = n if not self.elastic else (self.min_size if warmup is None else min(warmup, n))
+        self.active = max(self.min_size, warmup)
+        for i in xrange(warmup):
+            self.conns[i] = connection_cls(**options)
+
+        for i in xrange(n):
             q = Queue()
             self.queues.append(q)
-            g = gevent.spawn(self.loop, c, q)
+            g = gevent.spawn(self.loop, q, i)
             self.tasks.append(g)
 
-        assert len(self.conns) == n
+        if self.metrics is not None and stats_interval:
+            gevent.spawn(self.report_loop, stats_interval, stats_callback)
 
-    def loop(self, c, q):
+    def loop(self, q, i):
         """
-        :param c: 连接对象
         :param q: q格式: op-操作名(rpc的调用名等) ..
+        :param i: 队列下标, 连接对象是 self.conns[i]
         """
         while True:
-            op, args, kwargs, async_result = q.get()
             try:
+                op, args, kwargs, async_result, t = q.get(timeout=self.idle_timeout if self.elastic else None)
+            except Empty:
+                self._shrink(i)
+                continue
+            start = time.time()
+            if self.elastic and start - t > self.grow_wait:
+                self._grow()
+            if self.metrics is not None:
+                self.metrics.started(i)
+            ok = True
+            try:
+                c = self.conns[i]
+                if c is None:
+                    c = self.conns[i] = self.connection_cls(**self.options)
                 rs = getattr(c, op)(*args, **kwargs)
                 if async_result:
                     async_result.set(rs)
             except Exception as e:
+                ok = False
                 logger.error('[Last call]: %s %s', op, str(args), exc_info=1)
                 if async_result:
                     async_result.set_exception(Exception(sys.exc_info()[1]))
                 else:
                     logger.error(str(e))
             finally:
-                pass
+                if self.metrics is not None:
+                    self.metrics.record(i, op_name(op), start - t, time.time() - start, ok)
+                if self.dispatcher is not None:
+                    self.dispatcher.done(i)
 
-    def _selectq(self, qid=-1):
-        """选择第几个队列, 默认返回长度最小的队列
+    def _grow(self):
+        if self.active < len(self.queues):
+            self.active += 1
+            logger.info('pool grow to %d', self.active)
+
+    def _shrink(self, i):
+        """只关闭最后一个活跃队列的连接, 保证活跃队列是前 active 个
+        """
+        if i != self.active - 1 or self.active <= self.min_size or not self.queues[i].empty():
+            return
+        self.active -= 1
+        c, self.conns[i] = self.conns[i], None
+        if c is not None and hasattr(c, 'close'):
+            try:
+                c.close()
+            except:
+                logger.warn('close connection except', exc_info=1)
+        logger.info('pool shrink to %d', self.active)
+
+    def _selectq(self, qid=-1, key=None):
+        """选择第几个队列, 默认返回长度最小的队列, 指定了 dispatch 时按策略选择(并计入未完成任务数)
         : 测试发现queue取qsize很耗时,如果queues数量过大,不采用这种方法,可以考虑使用随机选取
         """
+        if self.dispatcher is not None:
+            i = qid if qid >= 0 else self.dispatcher.select(key)
+            self.dispatcher.submitted(i)
+            return self.queues[i]
         if qid >= 0:
             return self.queues[qid]
-        minq = min(self.queues, key=lambda q: q.qsize())
+        minq = min(self.queues[:self.active], key=lambda q: q.qsize())
+        if self.elastic and minq.qsize() >= self.grow_qsize:
+            self._grow()
         return minq
 
-    def call(self, op, args=tuple(), kwargs={}, qid=-1, deferred=True):
+    def size(self):
+        """
+        :return: (活跃队列数, 已创建的连接数)
+        """
+        return self.active, sum(1 for c in self.conns if c is not None)
+
+    def stats(self):
+        """
+        :return: 见 pu.instrument.PoolMetrics.snapshot, 没有开启 metrics 时返回 None
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot([q.qsize() for q in self.queues])
+
+    def report_loop(self, interval, callback):
+        while True:
+            gevent.sleep(interval)
+            try:
+                callback(self.stats())
+            except Exception:
+                logger.error('stats callback except', exc_info=1)
+
+    def call(self, op, args=tuple(), kwargs={}, qid=-1, deferred=True, key=None):
         """
         :param deferred: 是否返回deferred
+        :param key: dispatch 为 'hash' 时按 key 选择队列
         :return: 如果deferred是True, 返回deferred, False返回None
         """
-        q = self._selectq(qid)
+        q = self._selectq(qid, key)
         if deferred:
             async_result = AsyncResult()
-            q.put((op, args, kwargs, async_result))
+            q.put((op, args, kwargs, async_result, time.time()))
             return async_result
         else:
-            q.put((op, args, kwargs, None))
+            q.put((op, args, kwargs, None, time.time()))
 
     def map(self, op, args_kwargs_lst=[], qid=-1, deferred=True, timeout=None):
         """并发map
@@ -88,3 +207,15 @@ class ConnectionPool(object):
                         args_kwargs_lst]
         return (d.get(timeout=timeout) for d in deferred_lst)
 
+    def acall(self, op, args=tuple(), kwargs={}, qid=-1, key=None):
+        """在 tornado coroutine 里使用: rs = yield pool.acall('fetchall', ('select 1',))
+        :return: tornado Future
+        """
+        return to_future(self.call(op, args, kwargs, qid=qid, deferred=True, key=key))
+
+    def amap(self, op, args_kwargs_lst=[], qid=-1):
+        """按完成顺序取结果, 见 pu.pool.ConnectionPool.amap
+        :return: tornado.gen.WaitIterator
+        """
+        return gen.WaitIterator(*[self.acall(op, args, kwargs or {}, qid=qid) for args, kwargs in args_kwargs_lst])
+
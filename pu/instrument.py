@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+"""db client 查询统计"""
+
+from threading import Lock
+import logging
+import math
+import re
+import time
+
+logger = logging.getLogger(__name__)
+
+_RE_STRING = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_RE_NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+_RE_IN_LIST = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)')
+_RE_SPACE = re.compile(r'\s+')
+
+_fingerprints = {}
+
+
+def fingerprint(query):
+    """把 sql 归一化成语句指纹, 常量替换成 ?
+    >>> fingerprint("SELECT * FROM book  WHERE id in (1, 2, 3) and name='abc'")
+    'select * from book where id in (?+) and name=?'
+    """
+    fp = _fingerprints.get(query)
+    if fp is None:
+        fp = _RE_STRING.sub('?', query)
+        fp = _RE_NUMBER.sub('?', fp)
+        fp = _RE_IN_LIST.sub('(?+)', fp)
+        fp = _RE_SPACE.sub(' ', fp).strip().lower()
+        if len(_fingerprints) > 10000:
+            _fingerprints.clear()
+        _fingerprints[query] = fp
+    return fp
+
+
+def rows_size(rows):
+    """估算结果集的字节数
+    """
+    size = 0
+    for row in rows:
+        for value in (row.itervalues() if isinstance(row, dict) else row):
+            if isinstance(value, basestring):
+                size += len(value)
+            elif value is not None:
+                size += 8
+    return size
+
+
+class Instrument(object):
+    """查询钩子, 连接的 instrument 参数传入, 多个连接可以共用一个
+    : pre hook: hook(statement)
+    : post hook: hook(statement, latency, rows, nbytes), 只有执行成功的查询才会调用
+    : statement 是 fingerprint 归一化后的语句, latency 单位秒, rows 是结果行数或影响行数, nbytes 是结果字节数估算
+    用法:
+        histogram = StatementHistogram()
+        instrument = Instrument()
+        instrument.add_post_hook(histogram)
+        instrument.add_post_hook(SlowQueryLogger(0.5))
+        conn = MySQLdbConnection(instrument=instrument, **options)
+    """
+
+    def __init__(self):
+        self.pre_hooks = []
+        self.post_hooks = []
+
+    def add_pre_hook(self, hook):
+        assert callable(hook)
+        self.pre_hooks.append(hook)
+
+    def add_post_hook(self, hook):
+        assert callable(hook)
+        self.post_hooks.append(hook)
+
+    def before(self, query):
+        """
+        :return: 开始时间, 传给 after
+        """
+        if self.pre_hooks:
+            statement = fingerprint(query)
+            for hook in self.pre_hooks:
+                hook(statement)
+        return time.time()
+
+    def after(self, query, start, rows=0, nbytes=0):
+        latency = time.time() - start
+        if self.post_hooks:
+            statement = fingerprint(query)
+            for hook in self.post_hooks:
+                hook(statement, latency, rows, nbytes)
+
+
+class Histogram(object):
+    """按 2 的指数分桶的延迟直方图, 第 i 个桶是 [min_value * 2^(i-1), min_value * 2^i)
+    """
+
+    def __init__(self, min_value=0.0001, buckets=24):
+        self.min_value = min_value
+        self.counts = [0] * buckets
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        if value < self.min_value:
+            i = 0
+        else:
+            i = min(int(math.log(value / self.min_value, 2)) + 1, len(self.counts) - 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        """
+        :return: p(0~100) 分位数所在桶的上界
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100.0
+        n = 0
+        for i, c in enumerate(self.counts):
+            n += c
+            if n >= rank:
+                return min(self.min_value * 2 ** i, self.max)
+        return self.max
+
+    def snapshot(self):
+        return dict(count=self.count, total=self.total, avg=self.count and self.total / self.count or 0.0,
+                    max=self.max, p50=self.percentile(50), p90=self.percentile(90), p99=self.percentile(99))
+
+
+class StatementHistogram(object):
+    """post hook, 按语句指纹统计延迟直方图, 行数和字节数
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.statements = {}
+
+    def __call__(self, statement, latency, rows, nbytes):
+        with self.lock:
+            stat = self.statements.get(statement)
+            if stat is None:
+                stat = self.statements[statement] = [Histogram(), 0, 0]
+            stat[0].add(latency)
+            stat[1] += max(rows, 0)
+            stat[2] += nbytes
+
+    def stats(self):
+        """
+        :return: {statement: {count, total, avg, max, p50, p90, p99, rows, nbytes}}
+        """
+        with self.lock:
+            result = {}
+            for statement, (histogram, rows, nbytes) in self.statements.iteritems():
+                result[statement] = histogram.snapshot()
+                result[statement].update(rows=rows, nbytes=nbytes)
+            return result
+
+    def top(self, n=10, key='total'):
+        """
+        :return: 按 key 排序的前 n 个 (statement, stat)
+        """
+        return sorted(self.stats().iteritems(), key=lambda item: item[1][key], reverse=True)[:n]
+
+    def reset(self):
+        with self.lock:
+            self.statements.clear()
+
+
+class SlowQueryLogger(object):
+    """post hook, 超过 threshold 秒的查询打 warn 日志
+    """
+
+    def __init__(self, threshold=1.0, logger=logger):
+        self.threshold = threshold
+        self.logger = logger
+
+    def __call__(self, statement, latency, rows, nbytes):
+        if latency >= self.threshold:
+            self.logger.warn('[Slow query]: %.3fs rows: %s bytes: %s sql: %s', latency, rows, nbytes, statement)
+
+
+class PoolMetrics(object):
+    """连接池统计: 整个池, 每个队列, 每个 op 的排队时间(wait)和执行时间(service)直方图, 调用数和异常数
+    : 每个队列还记录当前调用开始的时间, 用来发现卡住的连接
+    """
+
+    def __init__(self, n):
+        self.lock = Lock()
+        self.pool = self._new()
+        self.queues = [self._new() for _ in xrange(n)]
+        self.busy_since = [None] * n
+        self.ops = {}
+
+    @staticmethod
+    def _new():
+        return [Histogram(), Histogram(), 0, 0]  # wait, service, calls, errors
+
+    def started(self, i):
+        self.busy_since[i] = time.time()
+
+    def record(self, i, op, wait, service, ok=True):
+        """
+        :param i: 队列下标
+        :param op: op 名
+        """
+        self.busy_since[i] = None
+        with self.lock:
+            stat = self.ops.get(op)
+            if stat is None:
+                stat = self.ops[op] = self._new()
+            for stat in (self.pool, self.queues[i], stat):
+                stat[0].add(wait)
+                stat[1].add(service)
+                stat[2] += 1
+                if not ok:
+                    stat[3] += 1
+
+    @staticmethod
+    def _snapshot(stat):
+        wait, service, calls, errors = stat
+        return dict(calls=calls, errors=errors, wait=wait.snapshot(), service=service.snapshot())
+
+    def snapshot(self, depths):
+        """
+        :param depths: 每个队列当前长度
+        :return: {'pool': {calls, errors, wait, service, depth},
+                  'queues': [{calls, errors, wait, service, depth, busy}, ..],
+                  'ops': {op: {calls, errors, wait, service}}}
+                  wait/service 是 Histogram.snapshot(), busy 是当前调用已执行秒数, 空闲时为 0
+        """
+        now = time.time()
+        with self.lock:
+            pool = self._snapshot(self.pool)
+            pool['depth'] = sum(depths)
+            queues = []
+            for stat, depth, since in zip(self.queues, depths, self.busy_since):
+                queue = self._snapshot(stat)
+                queue.update(depth=depth, busy=now - since if since is not None else 0.0)
+                queues.append(queue)
+            ops = dict((op, self._snapshot(stat)) for op, stat in self.ops.iteritems())
+        return {'pool': pool, 'queues': queues, 'ops': ops}
+
+    def reset(self):
+        with self.lock:
+            self.pool = self._new()
+            self.queues = [self._new() for _ in self.queues]
+            self.ops = {}
+
+
+def op_name(op):
+    return op if isinstance(op, basestring) else getattr(op, '__name__', repr(op))
+
+
+if __name__ == '__main__':
+    import doctest
+
+    doctest.testmod()
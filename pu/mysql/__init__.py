@@ -5,4 +5,5 @@
 mysql db utils
 """
 
-from client import MySQLdbConnection, PyMySQLConnection, UMySQLConnection
\ No newline at end of file
+from client import MySQLdbConnection, PyMySQLConnection, UMySQLConnection
+from router import ReadWriteConnection
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" description
+tornado 非阻塞 mysql db client
+tornado_mysql
+"""
+
+import logging
+
+from tornado import gen
+from tornado.ioloop import IOLoop
+import tornado_mysql
+import tornado_mysql.cursors
+
+from ..instrument import rows_size
+from .client import ReconnectPolicy, row_maker, make_rows
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncMySQLConnection(object):
+    """非阻塞连接, 方法都返回 Future, 在 tornado coroutine 里 yield 取结果
+    : 一个连接同一时间只能执行一个查询, 并发请用多个连接
+    example:
+        conn = AsyncMySQLConnection(**options)
+        rows = yield conn.fetchall('select * from book where author=%s', u'大大')
+    """
+
+    def __init__(self, host, user, passwd, db, port=3306, autocommit=True, charset='utf8', retry_delay=0,
+                 retry_times=0, row_factory=None, instrument=None, reconnect_policy=None):
+        """
+        :param retry_delay: 重连等待时间, 0-不重连
+        :param reconnect_policy: pu.mysql.client.ReconnectPolicy, 给定时忽略 retry_delay 和 retry_times
+            : 不管 blocking 与否都重试 retry_times 次, 等待用 gen.sleep, 不阻塞 IOLoop
+        :param row_factory: 行类型, None-Row(dict), 'compact'-基于 tuple 的 CompactRow(省内存, 构造快)
+        :param instrument: pu.instrument.Instrument, 查询钩子
+        : 第一次查询时才连接
+        """
+        self.row_factory = row_factory
+        self.instrument = instrument
+        self.args = dict(passwd=passwd, user=user, autocommit=autocommit, charset=charset, db=db)
+        if '/' in host:
+            self.args['unix_socket'] = host
+        else:
+            self.args['host'] = host
+            self.args['port'] = port
+        self.reconnect_policy = reconnect_policy or ReconnectPolicy(retry_delay, retry_times, backoff=1,
+                                                                    max_delay=retry_delay, jitter=0, blocking=True)
+        self.retry_delay = self.reconnect_policy.delay
+        self.retry_times = self.reconnect_policy.retry_times
+        self.conn = None
+
+    def probe(self):
+        """探测数据库是否可用, 在 ReconnectPolicy 的探测线程里用单独的 IOLoop 执行
+        """
+        io_loop = IOLoop()
+        try:
+            io_loop.run_sync(lambda: tornado_mysql.connect(**self.args)).close()
+        finally:
+            io_loop.close()
+
+    @gen.coroutine
+    def reconnect(self):
+        if not self.reconnect_policy.allow():
+            logger.warn('circuit open, not reconnect')
+            return
+        i = 0
+        while True:
+            i += 1
+            self.close()
+            try:
+                logger.info('trying reconnect..')
+                self.conn = yield tornado_mysql.connect(**self.args)
+                self.reconnect_policy.success()
+                logger.info('reconnected.')
+                break
+            except Exception:
+                logger.error('reconnect except', exc_info=1)
+            if i >= self.retry_times:
+                self.reconnect_policy.failure(self.probe)
+                return
+            yield gen.sleep(self.reconnect_policy.get_delay(i - 1))
+
+    @gen.coroutine
+    def execute(self, query, *args, **kwargs):
+        """Executes the given query, returning the lastrowid from the query."""
+        start = self.instrument and self.instrument.before(query)
+        cursor = yield self._execute(query, args, kwargs)
+        if cursor is False:
+            raise gen.Return(False)
+        yield cursor.close()
+        if start:
+            self.instrument.after(query, start, cursor.rowcount)
+        raise gen.Return(cursor.lastrowid)
+
+    @gen.coroutine
+    def executemany(self, query, args):
+        """Executes the given query against all the given param sequences.
+        We return the lastrowid from the query.
+        """
+        start = self.instrument and self.instrument.before(query)
+        cursor = yield self._execute(query, args, {}, many=True)
+        if cursor is False:
+            raise gen.Return(False)
+        yield cursor.close()
+        if start:
+            self.instrument.after(query, start, cursor.rowcount)
+        raise gen.Return(cursor.lastrowid)
+
+    @gen.coroutine
+    def fetchall(self, query, *args, **kwargs):
+        """Returns a row list for the given query and args."""
+        start = self.instrument and self.instrument.before(query)
+        cursor = yield self._execute(query, args, kwargs)
+        if cursor is False:
+            raise gen.Return(False)
+        rows = make_rows(cursor, self.row_factory)
+        yield cursor.close()
+        if start:
+            self.instrument.after(query, start, len(rows), rows_size(rows))
+        raise gen.Return(rows)
+
+    @gen.coroutine
+    def fetchone(self, query, *args, **kwargs):
+        """Returns the (singular) row returned by the given query.
+        If the query has no results, returns None.
+        """
+        rows = yield self.fetchall(query, *args, **kwargs)
+        if rows is False:
+            raise gen.Return(False)
+        elif not rows:
+            raise gen.Return(None)
+        elif len(rows) > 1:
+            logger.warn('Multiple rows returned for fetchone')
+        raise gen.Return(rows[0])
+
+    @gen.coroutine
+    def iterate(self, query, *args, **kwargs):
+        """使用服务端游标(SSCursor)分批拉取
+        :param batch_size: 每批从服务端拉取的行数, 默认1000
+        :return: False-查询失败, 否则返回 RowStream
+        example:
+            stream = yield conn.iterate('select * from book', batch_size=100)
+            while True:
+                rows = yield stream.fetch()
+                if not rows:
+                    break
+        """
+        batch_size = kwargs.pop('batch_size', 1000)
+        cursor = yield self._execute(query, args, kwargs, tornado_mysql.cursors.SSCursor)
+        if cursor is False:
+            raise gen.Return(False)
+        raise gen.Return(RowStream(cursor, batch_size, self.row_factory))
+
+    @gen.coroutine
+    def get_fields(self, table_name):
+        cursor = yield self._execute('select * from %s limit 0' % table_name, tuple(), {})
+        if cursor is False:
+            raise gen.Return(False)
+        yield cursor.close()
+        raise gen.Return([i[0] for i in cursor.description])
+
+    @gen.coroutine
+    def _run(self, query, args, cursorclass, many):
+        if self.conn is None:
+            self.conn = yield tornado_mysql.connect(**self.args)
+        cursor = self.conn.cursor(cursorclass)
+        if many:
+            yield cursor.executemany(query, args)
+        else:
+            yield cursor.execute(query, args)
+        raise gen.Return(cursor)
+
+    @gen.coroutine
+    def _execute(self, query, args, kwargs, cursorclass=None, many=False):
+        """
+        :return: cursor, False-表示不重连的时候查询失败(或者是重练成功后又执行失败)
+        """
+        if not self.reconnect_policy.allow():
+            logger.warn('[Circuit open]: %s', query)
+            raise gen.Return(False)
+        logger.debug('sql: %s, args: %s', query, str(args))
+        try:
+            cursor = yield self._run(query, args or kwargs, cursorclass, many)
+        except Exception:
+            logger.warn('[Error query]: %s args: %s', query, str(args), exc_info=1)
+            if self.retry_delay > 0:
+                yield self.reconnect()
+                try:
+                    cursor = yield self._run(query, args or kwargs, cursorclass, many)
+                except Exception:
+                    logger.error('[Error query]:sql: %s args: %s', query, str(args), exc_info=1)
+                    cursor = False
+            else:
+                logger.error('[Error query]:sql: %s args: %s. Not reconnect', query, str(args), exc_info=1)
+                self.close()
+                cursor = False
+        raise gen.Return(cursor)
+
+    def close(self):
+        try:
+            self.conn.close()
+        except:
+            pass
+        self.conn = None
+
+    def __del__(self):
+        self.close()
+
+
+class RowStream(object):
+    """AsyncMySQLConnection.iterate 的结果, 读完或 close 后释放游标
+    """
+
+    def __init__(self, cursor, batch_size, row_factory=None):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.make_row = row_maker([d[0] for d in cursor.description], row_factory)
+
+    @gen.coroutine
+    def fetch(self):
+        """
+        :return: 下一批 rows, 空 list 表示已读完
+        """
+        if self.cursor is None:
+            raise gen.Return([])
+        rows = yield self.cursor.fetchmany(self.batch_size)
+        if not rows:
+            yield self.close()
+        raise gen.Return([self.make_row(row) for row in rows])
+
+    @gen.coroutine
+    def close(self):
+        """提前结束时需要调用, 会读掉服务端剩余的结果
+        """
+        if self.cursor is not None:
+            cursor, self.cursor = self.cursor, None
+            yield cursor.close()
+
+
+def test_async_client():
+    from tornado.ioloop import IOLoop
+
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s %(levelname)s:%(module)s] %(message)s')
+
+    options = dict(host='localhost', user='root', passwd='112358', db='test', retry_delay=5, retry_times=5)
+
+    @gen.coroutine
+    def main():
+        conn = AsyncMySQLConnection(**options)
+        print (yield conn.fetchall('select * from book where author=%s', u'大大'))
+        print (yield conn.execute('insert into book set name="abc", author=%s', u'大大'))
+        print (yield conn.get_fields('book'))
+        stream = yield conn.iterate('select * from book', batch_size=100)
+        while True:
+            rows = yield stream.fetch()
+            if not rows:
+                break
+            print rows
+
+    IOLoop.current().run_sync(main)
+
+
+def test_standin():
+    """用 mysql 协议替身测试 fetchall/execute/iterate 和断线重连, 不需要真的 mysql
+    """
+    from tornado.ioloop import IOLoop
+    from .standin import StandInServer
+
+    query = u"select * from book where author='\u5927\u5927'"
+    server = StandInServer({query: (['name', 'author'], [(u'a', u'\u5927\u5927'), (u'b', None)]),
+                            u'select * from book': (['name'], [(str(i),) for i in xrange(250)]),
+                            u'select * from missing': Exception("Table 'test.missing' doesn't exist")})
+    options = dict(host='127.0.0.1', user='root', passwd='', db='test', port=server.port, retry_delay=0.01,
+                   retry_times=3)
+
+    @gen.coroutine
+    def main():
+        conn = AsyncMySQLConnection(**options)
+        rows = yield conn.fetchall('select * from book where author=%s', u'\u5927\u5927')
+        assert rows == [{'name': u'a', 'author': u'\u5927\u5927'}, {'name': u'b', 'author': None}], rows
+        assert rows[0].name == u'a'
+        assert (yield conn.fetchone('select * from book where author=%s', u'\u5927\u5927')).name == u'a'
+        assert (yield conn.execute('insert into book set name=%s', 'c')) == 1
+        assert (yield conn.executemany('insert into book set name=%s', [('d',), ('e',)])) == 3
+
+        stream = yield conn.iterate('select * from book', batch_size=100)
+        names = []
+        while True:
+            rows = yield stream.fetch()
+            if not rows:
+                break
+            assert len(rows) <= 100
+            names.extend(row.name for row in rows)
+        assert names == [str(i) for i in xrange(250)]
+
+        # 断线后重连并重试
+        server.drop_connections()
+        rows = yield conn.fetchall('select * from book where author=%s', u'\u5927\u5927')
+        assert len(rows) == 2 and server.opened_count == 2, (rows, server.opened_count)
+
+        # 服务端返回错误时, 重连重试后仍然失败, 返回 False
+        assert (yield conn.fetchall('select * from missing')) is False
+
+        conn.close()
+        compact = AsyncMySQLConnection(row_factory='compact', **options)
+        rows = yield compact.fetchall('select * from book where author=%s', u'\u5927\u5927')
+        assert rows[0] == (u'a', u'\u5927\u5927') and rows[0].author == u'\u5927\u5927'
+        compact.close()
+
+    try:
+        IOLoop.current().run_sync(main)
+    finally:
+        server.close()
+    print 'ok', len(server.queries), 'queries'
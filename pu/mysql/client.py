@@ -6,9 +6,22 @@ mysql db client
 ultramysql, MySQLdb, pymysql
 """
 
+from collections import OrderedDict
+from contextlib import contextmanager
+from itertools import count
+from Queue import Queue, Empty
+from threading import Lock, Thread
 import logging
+import random
+import re
+import sys
 import time
 
+from ..columnar import fetch_columns, MYSQL_TYPECODES
+from ..datatype import compact_row_class
+from ..event import AsyncResult
+from ..instrument import rows_size
+
 logger = logging.getLogger(__name__)
 
 try:
@@ -20,29 +33,192 @@ try:
     import MySQLdb
     import MySQLdb.cursors
 except ImportError:
+    MySQLdb = None
     logger.warn('MySQLdb module not found.')
 
 
+class TransactionError(Exception):
+    pass
+
+
+class ReconnectPolicy(object):
+    """重连策略: 指数退避 + 随机抖动 + 熔断
+    : 同一个 policy 对象可以在多个连接之间共享(比如 ConnectionPool 的 options 里传同一个对象),
+    : 默认不阻塞调用线程: 每次 reconnect 只尝试一次, 失败后在退避时间内所有连接直接返回失败, 过了退避时间再尝试
+    : blocking=True 时在调用线程里 sleep 重试 retry_times 次(只传 retry_delay/retry_times 时的旧行为)
+    : 连续 failure_threshold 次重连失败后熔断, 所有连接直接返回失败, 由后台线程探测数据库恢复后再关闭熔断
+    """
+
+    def __init__(self, delay=1, retry_times=3, backoff=2, max_delay=30, jitter=0.2, failure_threshold=0,
+                 probe_interval=5, blocking=False):
+        """
+        :param delay: 第一次重连失败后的等待时间, 0-不重连
+        :param retry_times: blocking 时每次 reconnect 最多尝试的次数
+        :param backoff: 每次失败后等待时间的倍数
+        :param max_delay: 最长等待时间
+        :param jitter: 随机抖动比例, 等待时间在 [delay * (1 - jitter), delay] 之间
+        :param failure_threshold: 连续多少次 reconnect 失败后熔断, 0-不熔断
+        :param probe_interval: 熔断后后台探测数据库的间隔
+        :param blocking: True-在调用线程里 sleep 重试, False-失败后退避时间内直接失败, 不 sleep
+        """
+        self.delay = delay
+        self.retry_times = retry_times
+        self.backoff = backoff
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self.blocking = blocking
+        self.failures = 0
+        self.opened = False
+        self.retry_at = 0  # 非 blocking 时, 在这之前不重连, 查询直接失败
+        self.lock = Lock()
+
+    def get_delay(self, i):
+        """第 i 次(从0开始)失败后的等待时间
+        """
+        delay = min(self.max_delay, self.delay * self.backoff ** i)
+        if self.jitter:
+            delay *= 1 - self.jitter * random.random()
+        return delay
+
+    def allow(self):
+        """
+        :return: False-熔断中或者在退避时间内, 应该直接失败
+        """
+        return not self.opened and (not self.retry_at or time.time() >= self.retry_at)
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.retry_at = 0
+
+    def failure(self, probe):
+        """reconnect 失败
+        :param probe: 探测函数, 不抛异常表示数据库已恢复
+        """
+        with self.lock:
+            self.failures += 1
+            if not self.blocking:
+                self.retry_at = time.time() + self.get_delay(self.failures - 1)
+            if not self.failure_threshold or self.opened or self.failures < self.failure_threshold:
+                return
+            self.opened = True
+        logger.error('circuit opened after %d reconnect failures', self.failures)
+        t = Thread(target=self.probe_loop, args=(probe,))
+        t.setDaemon(True)
+        t.start()
+
+    def probe_loop(self, probe):
+        while True:
+            time.sleep(self.probe_interval)
+            try:
+                probe()
+            except:
+                logger.warn('probe failed', exc_info=1)
+                continue
+            with self.lock:
+                self.opened = False
+                self.failures = 0
+                self.retry_at = 0
+            logger.info('circuit closed.')
+            return
+
+
+_RE_PLACEHOLDER = re.compile(r'%(s|%)')
+
+
+class PreparedStatements(object):
+    """服务端预处理语句(SQL PREPARE/EXECUTE)的 LRU, 按 sql 文本缓存语句名, 用于 MySQLdb/PyMySQL
+    : 这两个驱动不支持二进制协议(COM_STMT_PREPARE), 每次执行是 SET @参数 + EXECUTE 两次往返,
+    : 省去的是服务端的解析和优化, 只有复杂语句(多表 join, 大 IN 列表等)解析优化比一次往返慢时才划算
+    : 语句属于连接, reconnect 后要 clear; 每个连接最多 size 个, 总数受服务端 max_prepared_stmt_count 限制
+    """
+
+    def __init__(self, size):
+        """
+        :param size: 最多缓存的语句数
+        """
+        self.size = size
+        self.statements = OrderedDict()  # sql: 语句名
+        self.names = count()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def preparable(query, args):
+        """只预处理有位置参数(%s)的语句, %(name)s 和带 ? 的语句直接执行
+        """
+        return (isinstance(args, (tuple, list)) and len(args) > 0 and '?' not in query
+                and '%' not in _RE_PLACEHOLDER.sub('', query))
+
+    def execute(self, cursor, query, args):
+        """
+        :return: cursor.execute(EXECUTE ..) 的返回值, 结果在 cursor 上
+        """
+        name = self.statements.pop(query, None)
+        if name is None:
+            self.misses += 1
+            name = 'pu_stmt_%d' % next(self.names)
+            text = _RE_PLACEHOLDER.sub(lambda m: '?' if m.group(1) == 's' else '%', query)
+            cursor.execute('PREPARE %s FROM %%s' % name, (text,))
+            if len(self.statements) >= self.size:
+                _, old_name = self.statements.popitem(last=False)
+                cursor.execute('DEALLOCATE PREPARE %s' % old_name)
+        else:
+            self.hits += 1
+        self.statements[query] = name
+        variables = ['@pu_p%d' % i for i in xrange(len(args))]
+        cursor.execute('SET ' + ', '.join('%s=%%s' % v for v in variables), args)
+        return cursor.execute('EXECUTE %s USING %s' % (name, ', '.join(variables)))
+
+    def clear(self):
+        self.statements.clear()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self.statements), capacity=self.size, hits=self.hits, misses=self.misses,
+                    hit_rate=total and float(self.hits) / total or 0.0)
+
+
 class MySQLdbConnection(object):
     def __init__(self, host, user, passwd, db, port=3306, autocommit=True, charset='utf8', retry_delay=0,
-                 retry_times=0):
+                 retry_times=0, row_factory=None, reconnect_policy=None, instrument=None, statement_cache_size=0):
         """
-        :param retry_delay: 重连等待时间, 0-不重连
+        :param retry_delay: 重连等待时间, 0-不重连, 在调用线程里 sleep 重试 retry_times 次(会阻塞)
+        :param reconnect_policy: ReconnectPolicy, 给定时忽略 retry_delay 和 retry_times, 默认失败后退避而不阻塞
+        :param row_factory: 行类型, None-Row(dict), 'compact'-基于 tuple 的 CompactRow(省内存, 构造快)
+        :param instrument: pu.instrument.Instrument, 查询钩子
+        :param statement_cache_size: 服务端预处理语句缓存的语句数, 0-不使用, 见 PreparedStatements
         """
+        self.row_factory = row_factory
+        self.instrument = instrument
+        self.statements = PreparedStatements(statement_cache_size) if statement_cache_size > 0 else None
         self.args = dict(passwd=passwd, user=user, charset=charset, db=db)
         if '/' in host:
             self.args['unix_socket'] = host
         else:
             self.args['host'] = host
             self.args['port'] = port
-        self.retry_delay = retry_delay
-        self.retry_times = retry_times
+        self.reconnect_policy = reconnect_policy or ReconnectPolicy(retry_delay, retry_times, backoff=1,
+                                                                    max_delay=retry_delay, jitter=0, blocking=True)
+        self.retry_delay = self.reconnect_policy.delay
+        self.retry_times = self.reconnect_policy.retry_times
+        self.in_transaction = False
         self.conn = MySQLdb.Connection(**self.args)
         self.autocommit = autocommit
         if self.autocommit:
             self.conn.autocommit(True)
 
+    def probe(self):
+        """探测数据库是否可用
+        """
+        MySQLdb.Connection(**self.args).close()
+
     def reconnect(self):
+        if not self.reconnect_policy.allow():
+            logger.warn('circuit open, not reconnect')
+            return
         i = 0
         while True:
             i += 1
@@ -55,13 +231,47 @@ class MySQLdbConnection(object):
                 self.conn = MySQLdb.Connection(**self.args)
                 if self.autocommit:
                     self.conn.autocommit(True)
+                if self.statements is not None:  # 预处理语句随旧连接失效
+                    self.statements.clear()
+                self.reconnect_policy.success()
                 logger.info('reconnected.')
                 break
             except:
                 logger.error('reconnect except', exc_info=1)
-            if i >= self.retry_times:
+            if not self.reconnect_policy.blocking or i >= self.retry_times:
+                self.reconnect_policy.failure(self.probe)
                 return
-            time.sleep(self.retry_delay)
+            time.sleep(self.reconnect_policy.get_delay(i - 1))
+
+    @contextmanager
+    def transaction(self):
+        """事务, 正常退出 commit, 异常退出 rollback
+        : 事务中查询失败会直接抛出异常(不返回 False), 也不会重连重试, 避免重连后事务被拆开
+        : 嵌套时内层并入外层事务
+        example:
+            with conn.transaction():
+                conn.execute(...)
+        """
+        if self.in_transaction:
+            yield self
+            return
+        result, cursor = self._execute('BEGIN', tuple(), {})
+        if result is False:
+            raise TransactionError('begin transaction failed')
+        cursor.close()
+        self.in_transaction = True
+        try:
+            yield self
+            self.conn.commit()
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self.conn.rollback()
+            except:
+                logger.error('rollback except', exc_info=1)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self.in_transaction = False
 
     def execute(self, query, *args, **kwargs):
         """Executes the given query, returning the lastrowid from the query."""
@@ -69,10 +279,13 @@ class MySQLdbConnection(object):
 
     def execute_lastrowid(self, query, *args, **kwargs):
         """Executes the given query, returning the lastrowid from the query."""
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._execute(query, args, kwargs)
             if result is False:
                 return False
+            if start:
+                self.instrument.after(query, start, cursor.rowcount)
             return cursor.lastrowid
         finally:
             if locals().get('cursor'):
@@ -80,12 +293,44 @@ class MySQLdbConnection(object):
 
     def fetchall(self, query, *args, **kwargs):
         """Returns a row list for the given query and args."""
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._execute(query, args, kwargs)
             if result is False:
                 return False
-            column_names = [d[0] for d in cursor.description]
-            return [Row(zip(column_names, row)) for row in cursor]
+            rows = make_rows(cursor, self.row_factory)
+            if start:
+                self.instrument.after(query, start, len(rows), rows_size(rows))
+            return rows
+        finally:
+            if locals().get('cursor'):
+                cursor.close()
+
+    def iterate(self, query, *args, **kwargs):
+        """Returns a row generator for the given query and args.
+        使用服务端游标(SSCursor)分批拉取, 不会把整个结果集加载到内存
+        :param batch_size: 每批从服务端拉取的行数, 默认1000
+        :return: False-查询失败, 否则返回 Row 迭代器(RowIterator)
+        : 结果未读完之前不能在同一个连接上执行其它查询; 提前结束迭代时调用 close() 关闭游标, 迭代器被回收时也会关闭
+        """
+        batch_size = kwargs.pop('batch_size', 1000)
+        result, cursor = self._execute(query, args, kwargs, MySQLdb.cursors.SSCursor)
+        if result is False:
+            return False
+        return RowIterator(cursor, batch_size, self.row_factory)
+
+    def fetch_columns(self, query, *args, **kwargs):
+        """Returns a {column name: array} dict for the given query and args.
+        使用服务端游标分批拉取, 按 cursor.description 的类型按列存储, 不构造每行的 Row
+        :param batch_size: 每批从服务端拉取的行数, 默认1000
+        :return: False-查询失败, 有 numpy 时 {column name: numpy array}, 否则 {column name: array.array 或 list}
+        """
+        batch_size = kwargs.pop('batch_size', 1000)
+        try:
+            result, cursor = self._execute(query, args, kwargs, MySQLdb.cursors.SSCursor)
+            if result is False:
+                return False
+            return fetch_columns(cursor, batch_size, MYSQL_TYPECODES)
         finally:
             if locals().get('cursor'):
                 cursor.close()
@@ -122,31 +367,55 @@ class MySQLdbConnection(object):
         """Executes the given query against all the given param sequences.
         We return the lastrowid from the query.
         """
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._executemany(query, args)
             if result is False:
                 return False
+            if start:
+                self.instrument.after(query, start, cursor.rowcount)
             return cursor.lastrowid
         finally:
             if locals().get('cursor'):
                 cursor.close()
 
-    def _execute(self, query, args, kwargs):
+    def _cursor_execute(self, cursor, query, args, kwargs, cursorclass):
+        if self.statements is not None and cursorclass is None and PreparedStatements.preparable(query, args):
+            return self.statements.execute(cursor, query, args)
+        return cursor.execute(query, args or kwargs)
+
+    def statement_cache_stats(self):
+        """
+        :return: 预处理语句缓存命中统计, None-没有开启
+        """
+        if self.statements is None:
+            return None
+        return self.statements.stats()
+
+    def _execute(self, query, args, kwargs, cursorclass=None):
         """
+        :param cursorclass: 游标类型, None-默认游标
         :return: [result, cursor], result: False-表示不重连的时候查询失败(或者是重练成功后又执行失败)
         """
-        cursor = self.conn.cursor()
+        if not self.reconnect_policy.allow():
+            if self.in_transaction:  # 事务中不能返回 False, 否则调用方会继续提交剩下的语句
+                raise TransactionError('circuit open in transaction: %s' % query)
+            logger.warn('[Circuit open]: %s', query)
+            return [False, None]
+        cursor = self.conn.cursor(cursorclass)
         try:
             logger.debug('sql: %s, args: %s', query, str(args))
-            return [cursor.execute(query, args or kwargs), cursor]
+            return [self._cursor_execute(cursor, query, args, kwargs, cursorclass), cursor]
         except:
+            if self.in_transaction:
+                raise
             logger.warn('[Error query]: %s args: %s', query, str(args), exc_info=1)
             if self.retry_delay > 0:
                 self.reconnect()
                 cursor.close()
                 try:
-                    cursor = self.conn.cursor()
-                    return [cursor.execute(query, args or kwargs), cursor]
+                    cursor = self.conn.cursor(cursorclass)
+                    return [self._cursor_execute(cursor, query, args, kwargs, cursorclass), cursor]
                 except:
                     logger.error('[Error query]:sql: %s args: %s', query, str(args), exc_info=1)
                     cursor.close()
@@ -164,11 +433,18 @@ class MySQLdbConnection(object):
         """
         :return: [result, cursor], result: False-表示不重连的时候查询失败(或者是重练成功后又执行失败)
         """
+        if not self.reconnect_policy.allow():
+            if self.in_transaction:  # 事务中不能返回 False, 否则调用方会继续提交剩下的语句
+                raise TransactionError('circuit open in transaction: %s' % query)
+            logger.warn('[Circuit open]: %s', query)
+            return [False, None]
         cursor = self.conn.cursor()
         try:
             logger.debug('sql: %s, args: %s', query, str(args))
             return [cursor.executemany(query, args), cursor]
         except:
+            if self.in_transaction:
+                raise
             logger.warn('[Error query]: %s args: %s', query, str(args), exc_info=1)
             if self.retry_delay > 0:
                 self.reconnect()
@@ -204,6 +480,61 @@ class MySQLdbConnection(object):
             logger.info('connection closed')
 
 
+def row_maker(column_names, row_factory=None):
+    """返回把 tuple 行转换成结果行的函数
+    """
+    if row_factory == 'compact':
+        return compact_row_class(column_names)
+    return lambda row: Row(zip(column_names, row))
+
+
+def make_rows(cursor, row_factory=None):
+    make_row = row_maker([d[0] for d in cursor.description], row_factory)
+    return [make_row(row) for row in cursor]
+
+
+class RowIterator(object):
+    """分批 fetchmany 的 Row 迭代器, 迭代结束, close() 或被回收时关闭游标
+    : 不用 generator, 因为 generator 在第一次 next() 之前被丢弃时不会执行 finally, 游标不会关闭
+    """
+
+    def __init__(self, cursor, batch_size, row_factory=None):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.rows = iter(())
+        try:
+            self.make_row = row_maker([d[0] for d in cursor.description], row_factory)
+        except:
+            self.close()
+            raise
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        while self.cursor is not None:
+            for row in self.rows:
+                return self.make_row(row)
+            try:
+                rows = self.cursor.fetchmany(self.batch_size)
+            except:
+                self.close()
+                raise
+            if not rows:
+                self.close()
+                break
+            self.rows = iter(rows)
+        raise StopIteration
+
+    def close(self):
+        cursor, self.cursor = self.cursor, None
+        if cursor is not None:
+            cursor.close()
+
+    def __del__(self):
+        self.close()
+
+
 class Row(dict):
     """A dict that allows for object-like property access syntax."""
 
@@ -237,27 +568,47 @@ if MySQLdb is not None:
 
 try:
     import pymysql
+    import pymysql.cursors
 except ImportError:
     logger.warn('ultrasql module not found. please: pip install pymysql')
 
 
 class PyMySQLConnection(object):
     def __init__(self, host, user, passwd, db, port=3306, autocommit=True, charset='utf8', retry_delay=0,
-                 retry_times=0):
+                 retry_times=0, row_factory=None, reconnect_policy=None,
+                 instrument=None, statement_cache_size=0):
         """
-        :param retry_delay: 重连等待时间, 0-不重连
+        :param retry_delay: 重连等待时间, 0-不重连, 在调用线程里 sleep 重试 retry_times 次(会阻塞)
+        :param reconnect_policy: ReconnectPolicy, 给定时忽略 retry_delay 和 retry_times, 默认失败后退避而不阻塞
+        :param row_factory: 行类型, None-Row(dict), 'compact'-基于 tuple 的 CompactRow(省内存, 构造快)
+        :param instrument: pu.instrument.Instrument, 查询钩子
+        :param statement_cache_size: 服务端预处理语句缓存的语句数, 0-不使用, 见 PreparedStatements
         """
+        self.row_factory = row_factory
+        self.instrument = instrument
+        self.statements = PreparedStatements(statement_cache_size) if statement_cache_size > 0 else None
         self.args = dict(passwd=passwd, user=user, autocommit=autocommit, charset=charset, database=db)
         if '/' in host:
             self.args['unix_socket'] = host
         else:
             self.args['host'] = host
             self.args['port'] = port
-        self.retry_delay = retry_delay
-        self.retry_times = retry_times
+        self.reconnect_policy = reconnect_policy or ReconnectPolicy(retry_delay, retry_times, backoff=1,
+                                                                    max_delay=retry_delay, jitter=0, blocking=True)
+        self.retry_delay = self.reconnect_policy.delay
+        self.retry_times = self.reconnect_policy.retry_times
+        self.in_transaction = False
         self.conn = pymysql.Connection(**self.args)
 
+    def probe(self):
+        """探测数据库是否可用
+        """
+        pymysql.Connection(**self.args).close()
+
     def reconnect(self):
+        if not self.reconnect_policy.allow():
+            logger.warn('circuit open, not reconnect')
+            return
         i = 0
         while True:
             i += 1
@@ -268,13 +619,47 @@ class PyMySQLConnection(object):
             try:
                 logger.info('trying reconnect..')
                 self.conn = pymysql.Connection(**self.args)
+                if self.statements is not None:  # 预处理语句随旧连接失效
+                    self.statements.clear()
+                self.reconnect_policy.success()
                 logger.info('reconnected.')
                 break
             except:
                 logger.error('reconnect except', exc_info=1)
-            if i >= self.retry_times:
+            if not self.reconnect_policy.blocking or i >= self.retry_times:
+                self.reconnect_policy.failure(self.probe)
                 return
-            time.sleep(self.retry_delay)
+            time.sleep(self.reconnect_policy.get_delay(i - 1))
+
+    @contextmanager
+    def transaction(self):
+        """事务, 正常退出 commit, 异常退出 rollback
+        : 事务中查询失败会直接抛出异常(不返回 False), 也不会重连重试, 避免重连后事务被拆开
+        : 嵌套时内层并入外层事务
+        example:
+            with conn.transaction():
+                conn.execute(...)
+        """
+        if self.in_transaction:
+            yield self
+            return
+        result, cursor = self._execute('BEGIN', tuple(), {})
+        if result is False:
+            raise TransactionError('begin transaction failed')
+        cursor.close()
+        self.in_transaction = True
+        try:
+            yield self
+            self.conn.commit()
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self.conn.rollback()
+            except:
+                logger.error('rollback except', exc_info=1)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self.in_transaction = False
 
     def execute(self, query, *args, **kwargs):
         """Executes the given query, returning the lastrowid from the query."""
@@ -282,10 +667,13 @@ class PyMySQLConnection(object):
 
     def execute_lastrowid(self, query, *args, **kwargs):
         """Executes the given query, returning the lastrowid from the query."""
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._execute(query, args, kwargs)
             if result is False:
                 return False
+            if start:
+                self.instrument.after(query, start, cursor.rowcount)
             return cursor.lastrowid
         finally:
             if locals().get('cursor'):
@@ -293,12 +681,44 @@ class PyMySQLConnection(object):
 
     def fetchall(self, query, *args, **kwargs):
         """Returns a row list for the given query and args."""
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._execute(query, args, kwargs)
             if result is False:
                 return False
-            column_names = [d[0] for d in cursor.description]
-            return [Row(zip(column_names, row)) for row in cursor]
+            rows = make_rows(cursor, self.row_factory)
+            if start:
+                self.instrument.after(query, start, len(rows), rows_size(rows))
+            return rows
+        finally:
+            if locals().get('cursor'):
+                cursor.close()
+
+    def iterate(self, query, *args, **kwargs):
+        """Returns a row generator for the given query and args.
+        使用服务端游标(SSCursor)分批拉取, 不会把整个结果集加载到内存
+        :param batch_size: 每批从服务端拉取的行数, 默认1000
+        :return: False-查询失败, 否则返回 Row 迭代器(RowIterator)
+        : 结果未读完之前不能在同一个连接上执行其它查询; 提前结束迭代时调用 close() 关闭游标, 迭代器被回收时也会关闭
+        """
+        batch_size = kwargs.pop('batch_size', 1000)
+        result, cursor = self._execute(query, args, kwargs, pymysql.cursors.SSCursor)
+        if result is False:
+            return False
+        return RowIterator(cursor, batch_size, self.row_factory)
+
+    def fetch_columns(self, query, *args, **kwargs):
+        """Returns a {column name: array} dict for the given query and args.
+        使用服务端游标分批拉取, 按 cursor.description 的类型按列存储, 不构造每行的 Row
+        :param batch_size: 每批从服务端拉取的行数, 默认1000
+        :return: False-查询失败, 有 numpy 时 {column name: numpy array}, 否则 {column name: array.array 或 list}
+        """
+        batch_size = kwargs.pop('batch_size', 1000)
+        try:
+            result, cursor = self._execute(query, args, kwargs, pymysql.cursors.SSCursor)
+            if result is False:
+                return False
+            return fetch_columns(cursor, batch_size, MYSQL_TYPECODES)
         finally:
             if locals().get('cursor'):
                 cursor.close()
@@ -335,31 +755,55 @@ class PyMySQLConnection(object):
         """Executes the given query against all the given param sequences.
         We return the lastrowid from the query.
         """
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._executemany(query, args)
             if result is False:
                 return False
+            if start:
+                self.instrument.after(query, start, cursor.rowcount)
             return cursor.lastrowid
         finally:
             if locals().get('cursor'):
                 cursor.close()
 
-    def _execute(self, query, args, kwargs):
+    def _cursor_execute(self, cursor, query, args, kwargs, cursorclass):
+        if self.statements is not None and cursorclass is None and PreparedStatements.preparable(query, args):
+            return self.statements.execute(cursor, query, args)
+        return cursor.execute(query, args or kwargs)
+
+    def statement_cache_stats(self):
         """
+        :return: 预处理语句缓存命中统计, None-没有开启
+        """
+        if self.statements is None:
+            return None
+        return self.statements.stats()
+
+    def _execute(self, query, args, kwargs, cursorclass=None):
+        """
+        :param cursorclass: 游标类型, None-默认游标
         :return: [result, cursor], result: False-表示不重连的时候查询失败(或者是重练成功后又执行失败)
         """
-        cursor = self.conn.cursor()
+        if not self.reconnect_policy.allow():
+            if self.in_transaction:  # 事务中不能返回 False, 否则调用方会继续提交剩下的语句
+                raise TransactionError('circuit open in transaction: %s' % query)
+            logger.warn('[Circuit open]: %s', query)
+            return [False, None]
+        cursor = self.conn.cursor(cursorclass)
         try:
             logger.debug('sql: %s, args: %s', query, str(args))
-            return [cursor.execute(query, args or kwargs), cursor]
+            return [self._cursor_execute(cursor, query, args, kwargs, cursorclass), cursor]
         except:
+            if self.in_transaction:
+                raise
             logger.warn('[Error query]: %s args: %s', query, str(args), exc_info=1)
             if self.retry_delay > 0:
                 self.reconnect()
                 cursor.close()
                 try:
-                    cursor = self.conn.cursor()
-                    return [cursor.execute(query, args or kwargs), cursor]
+                    cursor = self.conn.cursor(cursorclass)
+                    return [self._cursor_execute(cursor, query, args, kwargs, cursorclass), cursor]
                 except:
                     logger.error('[Error query]:sql: %s args: %s', query, str(args), exc_info=1)
                     cursor.close()
@@ -377,11 +821,18 @@ class PyMySQLConnection(object):
         """
         :return: [result, cursor], result: False-表示不重连的时候查询失败(或者是重练成功后又执行失败)
         """
+        if not self.reconnect_policy.allow():
+            if self.in_transaction:  # 事务中不能返回 False, 否则调用方会继续提交剩下的语句
+                raise TransactionError('circuit open in transaction: %s' % query)
+            logger.warn('[Circuit open]: %s', query)
+            return [False, None]
         cursor = self.conn.cursor()
         try:
             logger.debug('sql: %s, args: %s', query, str(args))
             return [cursor.executemany(query, args), cursor]
         except:
+            if self.in_transaction:
+                raise
             logger.warn('[Error query]: %s args: %s', query, str(args), exc_info=1)
             if self.retry_delay > 0:
                 self.reconnect()
@@ -423,19 +874,57 @@ except ImportError:
     logger.warn('ultrasql module not found. please: pip install umysql')
 
 
+RE_INSERT_VALUES = re.compile(r'(\s*(?:INSERT|REPLACE)\b.+\bVALUES?\s*)(\(\s*%s\s*(?:,\s*%s\s*)*\))(\s*(?:ON DUPLICATE.*)?);?\s*\Z',
+                              re.IGNORECASE | re.DOTALL)
+
+
+def estimate_args_size(args):
+    """估算参数转义后的长度(按最坏情况, 字符串每个字符都需要转义)
+    """
+    size = 0
+    for arg in args:
+        if isinstance(arg, unicode):
+            size += len(arg.encode('utf8')) * 2 + 3
+        elif isinstance(arg, str):
+            size += len(arg) * 2 + 3
+        else:
+            size += 24
+    return size
+
+
 class UMySQLConnection(object):
     def __init__(self, host, user, passwd, db, port=3306, autocommit=True, charset='utf8', retry_delay=0,
-                 retry_times=0):
+                 retry_times=0, row_factory=None, reconnect_policy=None,
+                 instrument=None):
         """
-        :param retry_delay: 重连等待时间, 0-不重连
+        :param retry_delay: 重连等待时间, 0-不重连, 在调用线程里 sleep 重试 retry_times 次(会阻塞)
+        :param reconnect_policy: ReconnectPolicy, 给定时忽略 retry_delay 和 retry_times, 默认失败后退避而不阻塞
+        :param row_factory: 行类型, None-Row(dict), 'compact'-基于 tuple 的 CompactRow(省内存, 构造快)
+        :param instrument: pu.instrument.Instrument, 查询钩子
         """
+        self.row_factory = row_factory
+        self.instrument = instrument
         self.args = (host, port, user, passwd, db, autocommit, charset)
-        self.retry_delay = retry_delay
-        self.retry_times = retry_times
+        self.reconnect_policy = reconnect_policy or ReconnectPolicy(retry_delay, retry_times, backoff=1,
+                                                                    max_delay=retry_delay, jitter=0, blocking=True)
+        self.retry_delay = self.reconnect_policy.delay
+        self.retry_times = self.reconnect_policy.retry_times
+        self.in_transaction = False
+        self.max_allowed_packet = None
         self.conn = umysql.Connection()
         self.conn.connect(*self.args)
 
+    def probe(self):
+        """探测数据库是否可用
+        """
+        conn = umysql.Connection()
+        conn.connect(*self.args)
+        conn.close()
+
     def reconnect(self):
+        if not self.reconnect_policy.allow():
+            logger.warn('circuit open, not reconnect')
+            return
         i = 0
         while True:
             i += 1
@@ -444,22 +933,70 @@ class UMySQLConnection(object):
             try:
                 logger.info('trying reconnect..')
                 self.conn.connect(*self.args)
+                self.reconnect_policy.success()
                 logger.info('reconnected.')
                 break
             except:
                 logger.error('reconnect except', exc_info=1)
-            if i >= self.retry_times:
+            if not self.reconnect_policy.blocking or i >= self.retry_times:
+                self.reconnect_policy.failure(self.probe)
                 return
-            time.sleep(self.retry_delay)
+            time.sleep(self.reconnect_policy.get_delay(i - 1))
+
+    @contextmanager
+    def transaction(self):
+        """事务, 正常退出 commit, 异常退出 rollback
+        : 事务中查询失败会直接抛出异常(不返回 False), 也不会重连重试, 避免重连后事务被拆开
+        : 嵌套时内层并入外层事务
+        example:
+            with conn.transaction():
+                conn.execute(...)
+        """
+        if self.in_transaction:
+            yield self
+            return
+        if self.query('BEGIN') is False:
+            raise TransactionError('begin transaction failed')
+        self.in_transaction = True
+        try:
+            yield self
+            self.conn.query('COMMIT')
+        except:
+            exc_info = sys.exc_info()
+            try:
+                self.conn.query('ROLLBACK')
+            except:
+                logger.error('rollback except', exc_info=1)
+            raise exc_info[0], exc_info[1], exc_info[2]
+        finally:
+            self.in_transaction = False
 
     def query(self, sql, *args, **kwargs):
         """
         :return: False-表示不重连的时候查询失败
         """
+        if self.instrument is None:
+            return self._query(sql, args)
+        start = self.instrument.before(sql)
+        rs = self._query(sql, args)
+        if isinstance(rs, tuple):
+            self.instrument.after(sql, start, rs[0])
+        elif rs is not False:
+            self.instrument.after(sql, start, len(rs.rows), rows_size(rs.rows))
+        return rs
+
+    def _query(self, sql, args):
+        if not self.reconnect_policy.allow():
+            if self.in_transaction:  # 事务中不能返回 False, 否则调用方会继续提交剩下的语句
+                raise TransactionError('circuit open in transaction: %s' % sql)
+            logger.warn('[Circuit open]: %s', sql)
+            return False
         logger.debug('sql: %s args: %s', sql, str(args))
         try:
             return self.conn.query(sql, args)
         except:
+            if self.in_transaction:
+                raise
             logger.warn('[Error query]: %s', sql, exc_info=1)
             if self.retry_delay > 0:
                 self.reconnect()
@@ -474,17 +1011,53 @@ class UMySQLConnection(object):
 
     def get_result_rows(self, rs):
         fields = [row[0] for row in rs.fields]
+        if self.row_factory == 'compact':
+            row_cls = compact_row_class(fields)
+            return [row_cls(row) for row in rs.rows]
         return [dict(zip(fields, row)) for row in rs.rows]
 
     def execute(self, sql, *args, **kwargs):
         return self.query(sql, *args, **kwargs)
 
     def executemany(self, sql, args):
-        """警告: 这个和前两个不同,不能提供高性能
+        """INSERT/REPLACE ... VALUES (%s, ..) 改写成多行 VALUES 分批执行, 每批不超过 max_allowed_packet
+        : 其它语句逐条执行(umysql 不支持 pipeline), ON DUPLICATE KEY UPDATE 里有 %s 时也逐条执行(参数不能按行拼接)
+        :return: lastrowid(和前两个一样, 是最后一批的 insert_id), False-查询失败
         """
         assert args
-        rets = [self.execute(sql, _args) for _args in args]
-        return all(rets)
+        m = RE_INSERT_VALUES.match(sql)
+        if m is None or '%s' in m.group(3):
+            rs = None
+            for _args in args:
+                rs = self.query(sql, *_args)
+                if rs is False:
+                    return False
+            return rs[1]
+
+        prefix, values, postfix = m.group(1), m.group(2), m.group(3)
+        max_size = self.get_max_allowed_packet() - len(prefix) - len(postfix)
+        rs = None
+        batch_values, batch_args, size = [], [], 0
+        for _args in args:
+            row_size = len(values) + estimate_args_size(_args) + 1
+            if batch_values and size + row_size > max_size:
+                rs = self.query(prefix + ','.join(batch_values) + postfix, *batch_args)
+                if rs is False:
+                    return False
+                batch_values, batch_args, size = [], [], 0
+            batch_values.append(values)
+            batch_args.extend(_args)
+            size += row_size
+        rs = self.query(prefix + ','.join(batch_values) + postfix, *batch_args)
+        if rs is False:
+            return False
+        return rs[1]
+
+    def get_max_allowed_packet(self):
+        if self.max_allowed_packet is None:
+            rs = self.query('select @@max_allowed_packet')
+            self.max_allowed_packet = rs and int(rs.rows[0][0]) or 1024 * 1024
+        return self.max_allowed_packet
 
     def fetchone(self, sql, *args, **kwargs):
         rs = self.query(sql, *args, **kwargs)
@@ -518,6 +1091,108 @@ class UMySQLConnection(object):
             logger.info('connection closed')
 
 
+class GroupCommitWriter(object):
+    """合并提交: 缓存很多小的 execute, 每 max_statements 条或每 max_delay 秒在一个事务里提交一次
+    : 独占 conn, 在自己的线程里执行, 适合高频写入事件流
+    : 退出前调用 close(), 把还没提交的语句提交完
+    example:
+        writer = GroupCommitWriter(PyMySQLConnection(**options), max_statements=500, max_delay=0.05)
+        writer.execute('insert into event (name) values (%s)', 'click')  # 返回 AsyncResult, 提交后得到 lastrowid
+        writer.close()
+    """
+
+    def __init__(self, conn, max_statements=100, max_delay=0.05):
+        """
+        :param conn: 有 transaction() 的连接, MySQLdbConnection/PyMySQLConnection/UMySQLConnection
+        :param max_statements: 每个事务最多的语句数
+        :param max_delay: 第一条语句最多等待多少秒被提交
+        """
+        self.conn = conn
+        self.max_statements = max_statements
+        self.max_delay = max_delay
+        self.queue = Queue()
+        self.lock = Lock()
+        self.closed = False
+        self.thread = Thread(target=self.loop)
+        self.thread.setDaemon(True)  # 主线程退出子线程退出
+        self.thread.start()
+
+    def execute(self, query, *args):
+        """
+        :return: AsyncResult, 提交后 set lastrowid, 事务失败 set_exception
+        """
+        async_result = AsyncResult()
+        with self.lock:
+            if self.closed:
+                raise Exception('group commit writer closed')
+            self.queue.put((query, args, async_result))
+        return async_result
+
+    def _mark(self, stop):
+        """放入标记, 标记之前的语句提交后 set 标记的 AsyncResult
+        """
+        async_result = AsyncResult()
+        self.queue.put((None, stop, async_result))
+        return async_result
+
+    def flush(self, timeout=None):
+        """等待已经 execute 的语句全部提交
+        :return: 是否在 timeout 内提交完
+        """
+        with self.lock:
+            if self.closed:
+                return not self.thread.is_alive()
+            marker = self._mark(False)
+        return marker.wait(timeout)
+
+    def close(self, timeout=None):
+        """不再接受新的语句, 提交剩下的语句后结束线程
+        :return: 是否在 timeout 内结束
+        """
+        with self.lock:
+            if not self.closed:
+                self.closed = True
+                self._mark(True)
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def loop(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.time() + self.max_delay
+            while len(batch) < self.max_statements and batch[-1][0] is not None:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except Empty:
+                    break
+            query, stop, marker = batch[-1]
+            if query is None:
+                batch.pop()
+            if batch:
+                self.commit(batch)
+            if query is None:
+                marker.set(True)
+                if stop:
+                    return
+
+    def commit(self, batch):
+        try:
+            with self.conn.transaction():
+                rowids = [self.conn.execute(query, *args) for query, args, _ in batch]
+        except Exception as e:
+            logger.error('[Group commit failed]: %d statements', len(batch), exc_info=1)
+            for _, _, async_result in batch:
+                async_result.set_exception(e)
+        else:
+            for (_, _, async_result), rowid in zip(batch, rowids):
+                if isinstance(rowid, tuple):  # umysql 返回 (affected_rows, insert_id)
+                    rowid = rowid[1]
+                async_result.set(rowid)
+
+
 def test_transaction():
     logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s %(levelname)s:%(module)s] %(message)s')
 
@@ -526,12 +1201,14 @@ def test_transaction():
     # conn = PyMySQLConnection(**options)
     conn = UMySQLConnection(**options)
     conn.execute('truncate book')
-    conn.execute('START TRANSACTION')
-    conn.execute('SET AUTOCOMMIT=0')
-    conn.execute('insert into book set name="abc", author=%s', u'zhangsan')
-    conn.execute('ROLLBACK')
-    conn.execute('COMMIT')
-    conn.execute('SET AUTOCOMMIT=1')
+    try:
+        with conn.transaction():
+            conn.execute('insert into book set name="abc", author=%s', u'zhangsan')
+            raise Exception('rollback')
+    except Exception:
+        pass
+    with conn.transaction():
+        conn.execute('insert into book set name="def", author=%s', u'lisi')
     print conn.fetchall('select * from book')
 
 
@@ -543,6 +1220,8 @@ def test_client():
     mysqldb_conn = MySQLdbConnection(**options)
     print mysqldb_conn.fetchall('select * from book where author=%s', u'大大')
     print mysqldb_conn.get_fields('book')
+    for row in mysqldb_conn.iterate('select * from book', batch_size=100):
+        print row
 
     umysql_conn = UMySQLConnection(**options)
     print umysql_conn.fetchall('select * from book where author=%s', u'大大')
@@ -557,3 +1236,16 @@ def test_client():
                                        ('c', u'王二')])
     print pymysql_conn.get_fields('book')
 
+
+
+def test_prepared_statements():
+    logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s %(levelname)s:%(module)s] %(message)s')
+
+    options = dict(host='localhost', user='root', passwd='112358', db='test', statement_cache_size=10)
+    for conn in (MySQLdbConnection(**options), PyMySQLConnection(**options)):
+        for _ in xrange(3):
+            print conn.fetchall('select * from book where author=%s', u'大大')
+        print conn.execute('insert into book set name="abc", author=%s', u'大大')
+        conn.reconnect()
+        print conn.fetchall('select * from book where author=%s', u'大大')
+        print conn.statement_cache_stats()
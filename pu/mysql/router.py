@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" description
+mysql 读写分离
+"""
+
+import logging
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class ReadWriteConnection(object):
+    """读写分离连接: fetchall/fetchone/iterate 发到从库, execute/executemany 发到主库
+    : 和 MySQLdbConnection 等方法一致, 可以直接作为 pu.pool.ConnectionPool 的 connection_cls
+    : 写之后的 sticky_seconds 秒内读走主库, 默认只对本连接有效; 在 ConnectionPool 里写和读可能分到不同的连接,
+    : 要 read-your-writes 需要在 options 里传一个共用的 pin(如 pin={}), 所有连接共享写入时间
+    example:
+        options = dict(connection_cls=PyMySQLConnection,
+                       primary=dict(host='db0', user='root', passwd='112358', db='test'),
+                       replicas=[dict(host='db1', ...), dict(host='db2', ...)],
+                       pin={})
+        pool = ConnectionPool(10, ReadWriteConnection, options)
+    """
+
+    def __init__(self, connection_cls, primary, replicas=(), weights=None, strategy='least_latency',
+                 sticky_seconds=1.0, down_seconds=30.0, pin=None):
+        """
+        :param connection_cls: 连接类, 如 PyMySQLConnection
+        :param primary: 主库连接参数
+        :param replicas: 从库连接参数 list
+        :param weights: 从库权重 list, 默认都是1, strategy 为 'weighted' 时使用
+        :param strategy: 'least_latency'-选平均延迟最小的从库, 'weighted'-平滑加权轮询
+        :param sticky_seconds: 写之后多少秒内的读也走主库(read-your-writes)
+        :param down_seconds: 从库连接或查询失败后多少秒内不再使用, 之后重新连接
+        :param pin: 记录最近写入时间的 dict, 多个连接传同一个对象时共享 read-your-writes, None-只对本连接有效
+        """
+        assert strategy in ('least_latency', 'weighted')
+        self.connection_cls = connection_cls
+        self.primary = connection_cls(**primary)
+        self.replica_options = list(replicas)
+        self.replicas = [None] * len(self.replica_options)  # None-没有连接, 在 down_until 之后重新连接
+        self.weights = list(weights or [1] * len(self.replicas))
+        self.current_weights = [0] * len(self.replicas)
+        self.latencies = [0.0] * len(self.replicas)
+        self.down_until = [0.0] * len(self.replicas)
+        self.strategy = strategy
+        self.sticky_seconds = sticky_seconds
+        self.down_seconds = down_seconds
+        self.pin = {} if pin is None else pin
+        for i in xrange(len(self.replicas)):
+            self._connect_replica(i)
+
+    def _connect_replica(self, i):
+        try:
+            self.replicas[i] = self.connection_cls(**self.replica_options[i])
+        except:
+            logger.error('replica connect except: %s', self.replica_options[i].get('host'), exc_info=1)
+            self._mark_down(i)
+        return self.replicas[i]
+
+    def _mark_down(self, i):
+        """从库 down_seconds 内不再使用, 关闭连接, 之后重新连接
+        """
+        logger.warn('replica %d down for %ss, fallback to primary', i, self.down_seconds)
+        self.down_until[i] = time.time() + self.down_seconds
+        replica, self.replicas[i] = self.replicas[i], None
+        if replica is not None and hasattr(replica, 'close'):
+            try:
+                replica.close()
+            except:
+                pass
+
+    def select_replica(self):
+        """
+        :return: 从库下标, -1-没有可用从库(或者刚写过), 使用主库
+        """
+        now = time.time()
+        if now < self.pin.get('until', 0.0):
+            return -1
+        healthy = [i for i in xrange(len(self.replicas)) if self.down_until[i] <= now]
+        if not healthy:
+            return -1
+        if self.strategy == 'least_latency':
+            return min(healthy, key=lambda i: self.latencies[i])
+        # nginx 的平滑加权轮询
+        total = 0
+        best = -1
+        for i in healthy:
+            self.current_weights[i] += self.weights[i]
+            total += self.weights[i]
+            if best < 0 or self.current_weights[i] > self.current_weights[best]:
+                best = i
+        self.current_weights[best] -= total
+        return best
+
+    def _read(self, op, query, args, kwargs):
+        i = self.select_replica()
+        if i >= 0:
+            replica = self.replicas[i] or self._connect_replica(i)
+            if replica is not None:
+                t0 = time.time()
+                try:
+                    rs = getattr(replica, op)(query, *args, **kwargs)
+                except:
+                    logger.error('[Replica query]: %d %s', i, query, exc_info=1)
+                    rs = False
+                if rs is not False:
+                    self.latencies[i] = self.latencies[i] * 0.8 + (time.time() - t0) * 0.2
+                    return rs
+                self._mark_down(i)
+        return getattr(self.primary, op)(query, *args, **kwargs)
+
+    def _write(self, op, *args, **kwargs):
+        if self.sticky_seconds > 0:
+            self.pin['until'] = time.time() + self.sticky_seconds
+        return getattr(self.primary, op)(*args, **kwargs)
+
+    def fetchall(self, query, *args, **kwargs):
+        return self._read('fetchall', query, args, kwargs)
+
+    def fetchone(self, query, *args, **kwargs):
+        return self._read('fetchone', query, args, kwargs)
+
+    def iterate(self, query, *args, **kwargs):
+        return self._read('iterate', query, args, kwargs)
+
+    def execute(self, query, *args, **kwargs):
+        return self._write('execute', query, *args, **kwargs)
+
+    def execute_lastrowid(self, query, *args, **kwargs):
+        return self._write('execute_lastrowid', query, *args, **kwargs)
+
+    def executemany(self, query, args):
+        return self._write('executemany', query, args)
+
+    def executemany_lastrowid(self, query, args):
+        return self._write('executemany_lastrowid', query, args)
+
+    def get_fields(self, table_name):
+        return self.primary.get_fields(table_name)
+
+    def reconnect(self):
+        self.primary.reconnect()
+        for i, replica in enumerate(self.replicas):
+            if replica is not None:
+                replica.reconnect()
+            else:
+                self._connect_replica(i)
+
+    def stats(self):
+        """
+        :return: 各从库的平均延迟和是否可用
+        """
+        now = time.time()
+        return [dict(latency=self.latencies[i], weight=self.weights[i],
+                     healthy=self.down_until[i] <= now, connected=self.replicas[i] is not None)
+                for i in xrange(len(self.replicas))]
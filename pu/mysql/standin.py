@@ -0,0 +1,184 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" description
+测试用的 mysql 协议替身服务器, 不需要真的 mysql
+"""
+
+from itertools import count
+from threading import Lock, Thread
+import SocketServer
+import logging
+import socket
+import struct
+
+logger = logging.getLogger(__name__)
+
+COM_QUIT = 1
+COM_QUERY = 3
+FIELD_TYPE_VAR_STRING = 253
+UTF8_GENERAL_CI = 33
+SERVER_STATUS_AUTOCOMMIT = 2
+# LONG_PASSWORD | CONNECT_WITH_DB | PROTOCOL_41 | TRANSACTIONS | SECURE_CONNECTION | MULTI_RESULTS
+CAPABILITIES = 0x1 | 0x8 | 0x200 | 0x2000 | 0x8000 | 0x20000
+
+
+def lenenc_int(n):
+    if n < 251:
+        return chr(n)
+    elif n < 1 << 16:
+        return '\xfc' + struct.pack('<H', n)
+    elif n < 1 << 24:
+        return '\xfd' + struct.pack('<I', n)[:3]
+    return '\xfe' + struct.pack('<Q', n)
+
+
+def lenenc_str(s):
+    if s is None:
+        return '\xfb'
+    if isinstance(s, unicode):
+        s = s.encode('utf-8')
+    elif not isinstance(s, str):
+        s = str(s)
+    return lenenc_int(len(s)) + s
+
+
+class Session(SocketServer.BaseRequestHandler):
+    """一个客户端连接: 握手(不校验密码)后循环处理 COM_QUERY, 其它命令都回 OK
+    """
+
+    def setup(self):
+        self.seq = 0
+        self.server.standin.opened(self.request)
+
+    def finish(self):
+        self.server.standin.closed(self.request)
+
+    def send(self, payload):
+        self.request.sendall(struct.pack('<I', len(payload))[:3] + chr(self.seq & 0xff) + payload)
+        self.seq += 1
+
+    def recv(self):
+        """
+        :return: 一个包的内容, None-连接已关闭
+        """
+        header = self.recv_exactly(4)
+        if header is None:
+            return None
+        self.seq = ord(header[3]) + 1
+        return self.recv_exactly(struct.unpack('<I', header[:3] + '\0')[0])
+
+    def recv_exactly(self, n):
+        data = ''
+        while len(data) < n:
+            try:
+                chunk = self.request.recv(n - len(data))
+            except socket.error:
+                return None
+            if not chunk:
+                return None
+            data += chunk
+        return data
+
+    def send_ok(self, affected_rows=0, insert_id=0):
+        self.send('\0' + lenenc_int(affected_rows) + lenenc_int(insert_id) +
+                  struct.pack('<HH', SERVER_STATUS_AUTOCOMMIT, 0))
+
+    def send_eof(self):
+        self.send('\xfe' + struct.pack('<HH', 0, SERVER_STATUS_AUTOCOMMIT))
+
+    def send_error(self, message, errno=1064):
+        self.send('\xff' + struct.pack('<H', errno) + '#42000' + message.encode('utf-8'))
+
+    def send_result(self, columns, rows):
+        """列都按 VAR_STRING(utf8) 发送, 客户端拿到的是 unicode
+        """
+        self.send(lenenc_int(len(columns)))
+        for name in columns:
+            self.send(''.join(lenenc_str(s) for s in ('def', 'test', 't', 't', name, name)) +
+                      '\x0c' + struct.pack('<HIBHB', UTF8_GENERAL_CI, 255, FIELD_TYPE_VAR_STRING, 0, 0) + '\0\0')
+        self.send_eof()
+        for row in rows:
+            self.send(''.join(lenenc_str(value) for value in row))
+        self.send_eof()
+
+    def handle(self):
+        standin = self.server.standin
+        self.send('\x0a' + '5.7.0-standin\0' + struct.pack('<I', standin.opened_count) + '12345678\0' +
+                  struct.pack('<HBHHB', CAPABILITIES & 0xffff, UTF8_GENERAL_CI, SERVER_STATUS_AUTOCOMMIT,
+                              CAPABILITIES >> 16, 21) + '\0' * 10 + '901234567890\0')
+        if self.recv() is None:
+            return
+        self.send_ok()
+        while True:
+            packet = self.recv()
+            if not packet or ord(packet[0]) == COM_QUIT:
+                return
+            self.seq = 1
+            if ord(packet[0]) != COM_QUERY:
+                self.send_ok()
+                continue
+            query = packet[1:].decode('utf-8')
+            standin.queries.append(query)
+            result = standin.results.get(query)
+            if isinstance(result, Exception):
+                self.send_error(str(result))
+            elif result is not None:
+                self.send_result(*result)
+            else:
+                self.send_ok(1, next(standin.insert_ids))
+
+
+class StandInServer(object):
+    """mysql 协议替身: 只实现握手, COM_QUERY(文本结果集) 和 COM_QUIT, 用于测试客户端
+    : 在 results 里的查询返回结果集或错误, 其它查询返回 OK(affected_rows=1, insert_id 递增)
+    example:
+        server = StandInServer({u"select * from book where author='a'": (['name', 'author'], [('x', 'a')])})
+        conn = AsyncMySQLConnection('127.0.0.1', 'root', '', 'test', port=server.port)
+        server.drop_connections()  # 模拟数据库重启, 客户端下一次查询失败
+        server.close()
+    """
+
+    def __init__(self, results=None, host='127.0.0.1', port=0):
+        """
+        :param results: {sql: (列名 list, rows) 或 Exception}, sql 是客户端转义参数后的完整语句
+        :param port: 0-随机端口, 启动后从 self.port 取
+        """
+        self.results = results or {}
+        self.queries = []  # 收到的所有查询
+        self.insert_ids = count(1)
+        self.opened_count = 0  # 累计连接数
+        self.sockets = set()
+        self.lock = Lock()
+        self.server = SocketServer.ThreadingTCPServer((host, port), Session)
+        self.server.daemon_threads = True
+        self.server.standin = self
+        self.port = self.server.server_address[1]
+        t = Thread(target=self.server.serve_forever)
+        t.setDaemon(True)
+        t.start()
+
+    def opened(self, sock):
+        with self.lock:
+            self.opened_count += 1
+            self.sockets.add(sock)
+
+    def closed(self, sock):
+        with self.lock:
+            self.sockets.discard(sock)
+
+    def drop_connections(self):
+        """断开所有客户端连接
+        """
+        with self.lock:
+            sockets, self.sockets = self.sockets, set()
+        for sock in sockets:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.drop_connections()
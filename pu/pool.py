@@ -1,68 +1,304 @@
 # -*- coding: utf-8 -*-
 """threading pool"""
 
-from threading import Thread
-from Queue import Queue
+from collections import deque
+from contextlib import contextmanager
+from itertools import count, islice
+from threading import Condition, Lock, Thread
+from Queue import Queue, LifoQueue, PriorityQueue, Empty
 import logging
+import random
 import sys
+import time
 
+from dispatch import make_dispatcher
+from instrument import PoolMetrics, op_name
 from event import AsyncResult
 
 logger = logging.getLogger(__name__)
 
+try:
+    from tornado.concurrent import Future
+    from tornado.ioloop import IOLoop
+    from tornado import gen
+except ImportError:
+    logger.warn('tornado module not found. acall/amap need tornado')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class DeadlineExceeded(PoolTimeout):
+    pass
+
+
+class LaneStats(object):
+    """按 priority 分 lane 统计: 提交数, 执行数, 过期丢弃数, 排队时间, 执行时间
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.lanes = {}
+
+    def _lane(self, priority):
+        lane = self.lanes.get(priority)
+        if lane is None:
+            lane = self.lanes[priority] = {'submitted': 0, 'done': 0, 'expired': 0, 'wait_total': 0.0,
+                                           'wait_max': 0.0, 'service_total': 0.0}
+        return lane
+
+    def submitted(self, priority):
+        with self.lock:
+            self._lane(priority)['submitted'] += 1
+
+    def waited(self, priority, wait, expired=False):
+        with self.lock:
+            lane = self._lane(priority)
+            lane['expired' if expired else 'done'] += 1
+            lane['wait_total'] += wait
+            lane['wait_max'] = max(lane['wait_max'], wait)
+
+    def served(self, priority, service):
+        with self.lock:
+            self._lane(priority)['service_total'] += service
+
+    def snapshot(self):
+        """
+        :return: {priority: {'submitted':, 'done':, 'expired':, 'pending':, 'wait_avg':, 'wait_max':, 'service_avg':}}
+        """
+        rs = {}
+        with self.lock:
+            for priority, lane in self.lanes.iteritems():
+                taken = lane['done'] + lane['expired']
+                rs[priority] = {
+                    'submitted': lane['submitted'],
+                    'done': lane['done'],
+                    'expired': lane['expired'],
+                    'pending': lane['submitted'] - taken,
+                    'wait_avg': lane['wait_total'] / taken if taken else 0.0,
+                    'wait_max': lane['wait_max'],
+                    'service_avg': lane['service_total'] / lane['done'] if lane['done'] else 0.0,
+                }
+        return rs
+
+
+def take_lane(item, stats):
+    """从 PriorityQueue 的元素 (priority, seq, deadline, enqueue_time, task) 取出任务
+    : 已过 deadline 的任务直接丢弃, 给它的 AsyncResult 设置 DeadlineExceeded
+    :return: (priority, task), 过期时 task 为 None
+    """
+    priority, _, deadline, t, task = item
+    now = time.time()
+    if deadline is not None and now > deadline:
+        stats.waited(priority, now - t, expired=True)
+        async_result = task[3]
+        if async_result:
+            async_result.set_exception(DeadlineExceeded('deadline exceeded after %.3fs in queue' % (now - t)))
+        return priority, None
+    stats.waited(priority, now - t)
+    return priority, task
+
+
+def to_future(async_result, io_loop=None):
+    """把 AsyncResult 转成 tornado Future, 结果通过 IOLoop.add_callback(线程安全) 交给 ioloop, 不占用等待线程
+    : 需要在 ioloop 线程里调用
+    """
+    io_loop = io_loop or IOLoop.current()
+    future = Future()
+
+    def resolve(result):
+        if result.exception is not None:
+            future.set_exception(result.exception)
+        else:
+            future.set_result(result.get())
+
+    async_result.add_done_callback(lambda result: io_loop.add_callback(resolve, result))
+    return future
+
+
+def run_chunk(call, chunk, i, out):
+    """执行一批任务, 结果按 (i, [(True, 结果) 或 (False, 异常), ..]) 放入 out
+    """
+    results = []
+    for args, kwargs in chunk:
+        try:
+            results.append((True, call(*args, **(kwargs or {}))))
+        except Exception as e:
+            logger.error('[Last call]: %s %s', call, str(args), exc_info=1)
+            results.append((False, e))
+    out.put((i, results))
+
+
+def imap_chunks(submit, args_kwargs_lst, chunksize, window, ordered, timeout):
+    """把任务按 chunksize 分批提交, 最多 window 批同时在执行, 所有结果通过一个 Queue 返回
+    :param submit: submit(chunk, i, out) 提交第 i 批
+    """
+    out = Queue()
+    it = iter(args_kwargs_lst)
+    chunks = iter(lambda: list(islice(it, chunksize)), [])
+    inflight = 0
+    for i, chunk in enumerate(islice(chunks, window)):
+        submit(chunk, i, out)
+        inflight += 1
+    next_submit = inflight
+    next_yield = 0
+    done = {}
+    while inflight:
+        try:
+            i, results = out.get(timeout=timeout)
+        except Empty:
+            raise PoolTimeout('no result in %ss' % timeout)
+        inflight -= 1
+        for chunk in islice(chunks, 1):
+            submit(chunk, next_submit, out)
+            next_submit += 1
+            inflight += 1
+        if ordered:
+            done[i] = results
+            while next_yield in done:
+                for ok, rs in done.pop(next_yield):
+                    if not ok:
+                        raise rs
+                    yield rs
+                next_yield += 1
+        else:
+            for ok, rs in results:
+                if not ok:
+                    raise rs
+                yield rs
+
 
 class Pool(object):
     """每个线程使用1个队列的线程池
     """
 
-    def __init__(self, n):
+    def __init__(self, n, steal=False, dispatch=None, lanes=False):
+        """
+        :param steal: True-work stealing 模式, 空闲线程从其它线程的队列尾部窃取任务, 避免慢任务阻塞后面的任务
+        :param dispatch: 非 steal 模式的队列选择策略, 见 pu.dispatch.make_dispatcher, None-选 qsize 最小的队列
+        :param lanes: True-使用优先级队列, spawn 的 priority 小的先执行, 同 priority 先进先出, 支持 deadline,
+            按 priority 统计见 self.lane_stats.snapshot(). 不能和 steal 一起使用
+        """
+        assert not (steal and lanes)
         self.queues = []
         self.tasks = []
+        self.steal = steal
+        self.dispatcher = None if steal else make_dispatcher(dispatch, n)
+        self.lanes = lanes
+        self.lane_stats = LaneStats() if lanes else None
+        self.seq = count()
 
-        for _ in xrange(n):
-            q = Queue()
-            self.queues.append(q)
-            t = Thread(target=self.loop, args=(q, ))
+        if self.steal:
+            self.deques = [deque() for _ in xrange(n)]  # 可以被窃取的任务
+            self.pinned = [deque() for _ in xrange(n)]  # 指定了 qid 的任务, 只由对应线程执行
+            self.cond = Condition(Lock())
+            self.counter = count()
+
+        for i in xrange(n):
+            if self.steal:
+                t = Thread(target=self.steal_loop, args=(i, ))
+            else:
+                q = PriorityQueue() if lanes else Queue()
+                self.queues.append(q)
+                t = Thread(target=self.loop, args=(q, i))
             t.setDaemon(True)  # 主线程退出子线程退出
             t.start()
             self.tasks.append(t)
 
-    def loop(self, q):
+    def run(self, func, args, kwargs, async_result):
+        try:
+            rs = func(*args, **kwargs)
+            if async_result:
+                async_result.set(rs)
+        except Exception as e:
+            logger.error('[Last call]: %s %s %s', func, str(args), str(kwargs), exc_info=1)
+            if async_result:
+                async_result.set_exception(Exception(sys.exc_info()[1]))
+            else:
+                logger.error(str(e))
+
+    def loop(self, q, i):
         while True:
-            func, args, kwargs, async_result = q.get()
+            if self.lanes:
+                priority, task = take_lane(q.get(), self.lane_stats)
+                if task is not None:
+                    start = time.time()
+                    self.run(*task)
+                    self.lane_stats.served(priority, time.time() - start)
+            else:
+                self.run(*q.get())
+            if self.dispatcher is not None:
+                self.dispatcher.done(i)
+
+    def steal_loop(self, i):
+        while True:
+            task = self._take(i)
+            if task is None:
+                with self.cond:
+                    task = self._take(i)
+                    if task is None:
+                        self.cond.wait()
+                        continue
+            self.run(*task)
+
+    def _take(self, i):
+        """先取自己队列的头部, 没有再随机从别的线程队列尾部窃取
+        """
+        for d in (self.pinned[i], self.deques[i]):
             try:
-                rs = func(*args, **kwargs)
-                if async_result:
-                    async_result.set(rs)
-            except Exception as e:
-                logger.error('[Last call]: %s %s %s', func, str(args), str(kwargs), exc_info=1)
-                if async_result:
-                    async_result.set_exception(Exception(sys.exc_info()[1]))
-                else:
-                    logger.error(str(e))
-            finally:
+                return d.popleft()
+            except IndexError:
+                pass
+        n = len(self.deques)
+        start = random.randrange(n)
+        for j in xrange(n):
+            try:
+                return self.deques[(start + j) % n].pop()
+            except IndexError:
                 pass
+        return None
 
-    def _selectq(self, qid=-1):
-        """选择第几个队列, 默认返回长度最小的队列
+    def _push(self, task, qid=-1):
+        if qid >= 0:
+            self.pinned[qid].append(task)
+            with self.cond:
+                self.cond.notify_all()  # 只有第 qid 个线程能执行, 要保证它被唤醒
+        else:
+            self.deques[next(self.counter) % len(self.deques)].append(task)
+            with self.cond:
+                self.cond.notify()
+
+    def _selectq(self, qid=-1, key=None):
+        """选择第几个队列, 默认返回长度最小的队列, 指定了 dispatch 时按策略选择(并计入未完成任务数)
         """
+        if self.dispatcher is not None:
+            i = qid if qid >= 0 else self.dispatcher.select(key)
+            self.dispatcher.submitted(i)
+            return self.queues[i]
         if qid >= 0:
             return self.queues[qid]
         minq = min(self.queues, key=lambda q: q.qsize())
         return minq
 
-    def spawn(self, func, args=tuple(), kwargs={}, qid=-1, deferred=False):
+    def spawn(self, func, args=tuple(), kwargs={}, qid=-1, deferred=False, key=None, priority=0, deadline=None):
         """
         :param deferred: 是否返回deferred
+        :param key: dispatch 为 'hash' 时按 key 选择队列
+        :param priority: lanes 模式下的优先级, 越小越先执行
+        :param deadline: lanes 模式下的截止时间(time.time() 时间戳), 开始执行时已过期则丢弃, deferred 抛出 DeadlineExceeded
         :return: 如果deferred是True, 返回deferred, False返回None
         """
-        q = self._selectq(qid)
-        if deferred:
-            async_result = AsyncResult()
-            q.put((func, args, kwargs, async_result))
-            return async_result
+        async_result = AsyncResult() if deferred else None
+        task = (func, args, kwargs, async_result)
+        if self.steal:
+            self._push(task, qid)
+        elif self.lanes:
+            self.lane_stats.submitted(priority)
+            self._selectq(qid, key).put((priority, next(self.seq), deadline, time.time(), task))
         else:
-            q.put((func, args, kwargs, None))
+            self._selectq(qid, key).put(task)
+        return async_result
 
     def map(self, func, args_kwargs_lst=[], qid=-1, deferred=True, timeout=None):
         """并发map
@@ -73,72 +309,224 @@ class Pool(object):
                         args_kwargs_lst]
         return (d.get(timeout=timeout) for d in deferred_lst)
 
+    def imap(self, func, args_kwargs_lst=[], chunksize=1, window=None, timeout=None, ordered=True):
+        """分批并发map, 一个队列任务执行 chunksize 个调用, 结果通过一个 Queue 返回, 不为每个调用创建 AsyncResult
+        :param args_kwargs_lst: args kwargs 序列(可以是 generator) => [(args, kwargs), ..]
+        :param window: 最多同时提交多少批, 默认线程数的2倍, 用于背压
+        :param timeout: 等待下一批结果的超时, 超时抛出 PoolTimeout
+        :param ordered: False-按完成顺序返回结果
+        :return 返回结果 generator, 某个调用抛出异常时在对应位置抛出
+        """
+        window = window or 2 * len(self.tasks)
+        submit = lambda chunk, i, out: self.spawn(run_chunk, args=(func, chunk, i, out))
+        return imap_chunks(submit, args_kwargs_lst, chunksize, window, ordered, timeout)
+
+    def imap_unordered(self, func, args_kwargs_lst=[], chunksize=1, window=None, timeout=None):
+        return self.imap(func, args_kwargs_lst, chunksize, window, timeout, ordered=False)
+
+
+def chunk_op(c, op, chunk, i, out):
+    try:
+        call = getattr(c, op)
+    except Exception as e:
+        logger.error('[Last call]: %s', op, exc_info=1)
+        out.put((i, [(False, e)] * len(chunk)))
+        return
+    run_chunk(call, chunk, i, out)
+
+
+def submit_chunk_op(call, op, chunk, i, out):
+    """提交一批任务到 ConnectionPool, 任务没有执行到 chunk_op(如创建连接失败)时也把这批的异常放入 out
+    """
+    def done(async_result):
+        if async_result.exception is not None:
+            out.put((i, [(False, async_result.exception)] * len(chunk)))
+
+    call(chunk_op, (op, chunk, i, out), deferred=True).add_done_callback(done)
+
 
 class ConnectionPool(object):
     """每个线程/连接使用1个队列的连接池(可用在rpc客户端, 数据库客户端等)
+    : 指定 min_size 时连接数在 [min_size, n] 之间伸缩: 线程和队列还是 n 个, 但只往前 active 个队列派发任务,
+    : 队列积压或任务排队过久时启用下一个队列(连接在它的线程里按需创建), 最后一个活跃队列空闲超过 idle_timeout 时关闭连接
     """
 
-    def __init__(self, n, connection_cls, options={}):
+    def __init__(self, n, connection_cls, options={}, dispatch=None, min_size=None, warmup=None, idle_timeout=60,
+                 grow_qsize=2, grow_wait=0.1, lanes=False, metrics=False, stats_interval=None, stats_callback=None):
         """
+        :param n: 最大连接数
         :param connection_cls: 连接客户端类, 最好在 connection_cls 内部实现重连等
         :param options: 连接客户端参数
+        :param dispatch: 队列选择策略, 见 pu.dispatch.make_dispatcher, None-选 qsize 最小的队列. 伸缩模式下不能使用
+        :param min_size: 最少连接数(至少1), None-不伸缩, 启动时创建 n 个连接
+        :param warmup: 启动时创建的连接数, 默认 min_size
+        :param idle_timeout: 伸缩模式下空闲多少秒关闭连接
+        :param grow_qsize: 伸缩模式下选中的队列长度达到多少时启用新连接
+        :param grow_wait: 伸缩模式下任务排队超过多少秒时启用新连接
+        :param lanes: True-使用优先级队列, 支持 call 的 priority/deadline, 见 Pool
+        :param metrics: True-统计排队时间, 执行时间等, 见 stats()
+        :param stats_interval: 每隔多少秒把 stats() 传给 stats_callback(stats), 需要 metrics
         """
+        assert min_size is None or dispatch is None
+        self.connection_cls = connection_cls
+        self.options = options
         self.queues = []
         self.tasks = []
-        self.conns = []
+        self.conns = [None] * n
+        self.dispatcher = make_dispatcher(dispatch, n)
+        self.elastic = min_size is not None
+        self.min_size = n if min_size is None else max(min_size, 1)  # 至少保留1个活跃队列
+        self.idle_timeout = idle_timeout
+        self.grow_qsize = grow_qsize
+        self.grow_wait = grow_wait
+        self.lock = Lock()
+        self.lanes = lanes
+        self.lane_stats = LaneStats() if lanes else None
+        self.seq = count()
+        self.metrics = PoolMetrics(n) if metrics else None
 
-        for _ in xrange(n):
-            c = connection_cls(**options)
-            self.conns.append(c)
-            q = Queue()
+        warmup = n if not self.elastic else (self.min_size if warmup is None else min(warmup, n))
+        self.active = max(self.min_size, warmup)
+        for i in xrange(warmup):
+            self.conns[i] = connection_cls(**options)
+
+        for i in xrange(n):
+            q = PriorityQueue() if lanes else Queue()
             self.queues.append(q)
-            t = Thread(target=self.loop, args=(c, q))
+            t = Thread(target=self.loop, args=(q, i))
             t.setDaemon(True)  # 主线程退出子线程退出
             t.start()
             self.tasks.append(t)
 
-        assert len(self.conns) == n
+        if self.metrics is not None and stats_interval:
+            t = Thread(target=self.report_loop, args=(stats_interval, stats_callback))
+            t.setDaemon(True)
+            t.start()
 
-    def loop(self, c, q):
+    def loop(self, q, i):
         """
-        :param c: 连接对象
-        :param q: q格式: op-操作名(rpc的调用名等) ..
+        :param q: q格式: op-操作名(rpc的调用名等, 也可以是函数 op(c, *args, **kwargs)) ..
+        :param i: 队列下标, 连接对象是 self.conns[i]
         """
         while True:
-            op, args, kwargs, async_result = q.get()
             try:
-                rs = getattr(c, op)(*args, **kwargs)
+                task = q.get(timeout=self.idle_timeout if self.elastic else None)
+            except Empty:
+                self._shrink(i)
+                continue
+            if self.lanes:
+                priority, task = take_lane(task, self.lane_stats)
+                if task is None:
+                    if self.dispatcher is not None:
+                        self.dispatcher.done(i)
+                    continue
+            op, args, kwargs, async_result, t = task
+            start = time.time()
+            if self.elastic and start - t > self.grow_wait:
+                self._grow()
+            if self.metrics is not None:
+                self.metrics.started(i)
+            ok = True
+            try:
+                c = self.conns[i]
+                if c is None:
+                    c = self.conns[i] = self.connection_cls(**self.options)
+                if callable(op):
+                    rs = op(c, *args, **kwargs)
+                else:
+                    rs = getattr(c, op)(*args, **kwargs)
                 if async_result:
                     async_result.set(rs)
             except Exception as e:
+                ok = False
                 logger.error('[Last call]: %s %s', op, str(args), exc_info=1)
                 if async_result:
                     async_result.set_exception(Exception(sys.exc_info()[1]))
                 else:
                     logger.error(str(e))
             finally:
-                pass
+                if self.metrics is not None:
+                    self.metrics.record(i, op_name(op), start - t, time.time() - start, ok)
+                if self.lanes:
+                    self.lane_stats.served(priority, time.time() - start)
+                if self.dispatcher is not None:
+                    self.dispatcher.done(i)
 
-    def _selectq(self, qid=-1):
-        """选择第几个队列, 默认返回长度最小的队列
+    def _grow(self):
+        with self.lock:
+            if self.active < len(self.queues):
+                self.active += 1
+                logger.info('pool grow to %d', self.active)
+
+    def _shrink(self, i):
+        """只关闭最后一个活跃队列的连接, 保证活跃队列是前 active 个
         """
+        with self.lock:
+            if i != self.active - 1 or self.active <= self.min_size or not self.queues[i].empty():
+                return
+            self.active -= 1
+        c, self.conns[i] = self.conns[i], None
+        if c is not None and hasattr(c, 'close'):
+            try:
+                c.close()
+            except:
+                logger.warn('close connection except', exc_info=1)
+        logger.info('pool shrink to %d', self.active)
+
+    def _selectq(self, qid=-1, key=None):
+        """选择第几个队列, 默认返回长度最小的队列, 指定了 dispatch 时按策略选择(并计入未完成任务数)
+        """
+        if self.dispatcher is not None:
+            i = qid if qid >= 0 else self.dispatcher.select(key)
+            self.dispatcher.submitted(i)
+            return self.queues[i]
         if qid >= 0:
             return self.queues[qid]
-        minq = min(self.queues, key=lambda q: q.qsize())
+        minq = min(self.queues[:self.active], key=lambda q: q.qsize())
+        if self.elastic and minq.qsize() >= self.grow_qsize:
+            self._grow()
         return minq
 
-    def call(self, op, args=tuple(), kwargs={}, qid=-1, deferred=True):
+    def size(self):
+        """
+        :return: (活跃队列数, 已创建的连接数)
+        """
+        return self.active, sum(1 for c in self.conns if c is not None)
+
+    def stats(self):
+        """
+        :return: 见 pu.instrument.PoolMetrics.snapshot, 没有开启 metrics 时返回 None
+        """
+        if self.metrics is None:
+            return None
+        return self.metrics.snapshot([q.qsize() for q in self.queues])
+
+    def report_loop(self, interval, callback):
+        while True:
+            time.sleep(interval)
+            try:
+                callback(self.stats())
+            except Exception:
+                logger.error('stats callback except', exc_info=1)
+
+    def call(self, op, args=tuple(), kwargs={}, qid=-1, deferred=True, key=None, priority=0, deadline=None):
         """
         :param deferred: 是否返回deferred
+        :param key: dispatch 为 'hash' 时按 key 选择队列
+        :param priority: lanes 模式下的优先级, 越小越先执行
+        :param deadline: lanes 模式下的截止时间(time.time() 时间戳), 见 Pool.spawn
         :return: 如果deferred是True, 返回deferred, False返回None
         """
-        q = self._selectq(qid)
-        if deferred:
-            async_result = AsyncResult()
-            q.put((op, args, kwargs, async_result))
-            return async_result
+        q = self._selectq(qid, key)
+        async_result = AsyncResult() if deferred else None
+        now = time.time()
+        task = (op, args, kwargs, async_result, now)
+        if self.lanes:
+            self.lane_stats.submitted(priority)
+            q.put((priority, next(self.seq), deadline, now, task))
         else:
-            q.put((op, args, kwargs, None))
+            q.put(task)
+        return async_result
 
     def map(self, op, args_kwargs_lst=[], qid=-1, deferred=True, timeout=None):
         """并发map
@@ -149,6 +537,166 @@ class ConnectionPool(object):
                         args_kwargs_lst]
         return (d.get(timeout=timeout) for d in deferred_lst)
 
+    def imap(self, op, args_kwargs_lst=[], chunksize=1, window=None, timeout=None, ordered=True):
+        """分批并发map, 一个队列任务在同一个连接上执行 chunksize 个调用, 参数见 Pool.imap
+        """
+        window = window or 2 * len(self.queues)
+        submit = lambda chunk, i, out: submit_chunk_op(self.call, op, chunk, i, out)
+        return imap_chunks(submit, args_kwargs_lst, chunksize, window, ordered, timeout)
+
+    def imap_unordered(self, op, args_kwargs_lst=[], chunksize=1, window=None, timeout=None):
+        return self.imap(op, args_kwargs_lst, chunksize, window, timeout, ordered=False)
+
+    def acall(self, op, args=tuple(), kwargs={}, qid=-1, key=None):
+        """在 tornado coroutine 里使用: rs = yield pool.acall('fetchall', ('select 1',))
+        :return: tornado Future
+        """
+        return to_future(self.call(op, args, kwargs, qid=qid, deferred=True, key=key))
+
+    def amap(self, op, args_kwargs_lst=[], qid=-1):
+        """按完成顺序取结果:
+            it = pool.amap('fetchone', [(('select %s', 1), {}), ..])
+            while not it.done():
+                rs = yield it.next()
+                i = it.current_index
+        :return: tornado.gen.WaitIterator
+        """
+        return gen.WaitIterator(*[self.acall(op, args, kwargs or {}, qid=qid) for args, kwargs in args_kwargs_lst])
+
+
+class CheckoutPool(object):
+    """借出/归还模式的连接池: 调用方直接拿到连接, 没有队列和线程切换, 可以在一个连接上执行多条语句
+    : 最多 n 个连接, 按需创建
+    example:
+        pool = CheckoutPool(10, PyMySQLConnection, options, timeout=1, max_uses=10000, max_age=3600)
+        with pool.connection() as conn:
+            conn.execute(...)
+            conn.fetchall(...)
+    """
+
+    def __init__(self, n, connection_cls, options={}, timeout=None, max_uses=None, max_age=None, health_check=None):
+        """
+        :param connection_cls: 连接客户端类, 最好在 connection_cls 内部实现重连等
+        :param options: 连接客户端参数
+        :param timeout: 借出连接时最多等待多少秒, None-一直等待
+        :param max_uses: 一个连接借出多少次后重建, None-不限制
+        :param max_age: 一个连接创建多少秒后重建, None-不限制
+        :param health_check: health_check(conn), 借出前检查, 返回 False 或抛异常时重建连接
+        """
+        self.connection_cls = connection_cls
+        self.options = options
+        self.timeout = timeout
+        self.max_uses = max_uses
+        self.max_age = max_age
+        self.health_check = health_check
+        self.idle = LifoQueue(n)  # 后进先出, 尽量复用热连接, 让多余的连接空闲
+        for _ in xrange(n):
+            self.idle.put(None)  # None-还没创建的连接
+
+    def _connect(self):
+        return [self.connection_cls(**self.options), time.time(), 0]
+
+    def _usable(self, entry):
+        c, created, uses = entry
+        if self.max_uses is not None and uses >= self.max_uses:
+            return False
+        if self.max_age is not None and time.time() - created >= self.max_age:
+            return False
+        if self.health_check is not None:
+            try:
+                return self.health_check(c) is not False  # 返回 None(如 c.ping()) 也算健康
+            except Exception:
+                logger.warn('health check except', exc_info=1)
+                return False
+        return True
+
+    def checkout(self, timeout=-1):
+        """
+        :param timeout: -1-使用 self.timeout
+        :return: [conn, created, uses], 用完必须 checkin
+        """
+        if timeout == -1:
+            timeout = self.timeout
+        try:
+            entry = self.idle.get(timeout=timeout)
+        except Empty:
+            raise PoolTimeout('no idle connection in %ss' % timeout)
+        try:
+            if entry is not None and not self._usable(entry):
+                self._close(entry)
+                entry = None
+            if entry is None:
+                entry = self._connect()
+        except:
+            self.idle.put(None)
+            raise
+        entry[2] += 1
+        return entry
+
+    def checkin(self, entry):
+        self.idle.put(entry)
+
+    def _close(self, entry):
+        c = entry[0]
+        if hasattr(c, 'close'):
+            try:
+                c.close()
+            except:
+                logger.warn('close connection except', exc_info=1)
+
+    def discard(self, entry):
+        """关闭借出的连接, 不再复用(比如使用时出错), 空出的位置下次借出时重建
+        """
+        self._close(entry)
+        self.idle.put(None)
+
+    @contextmanager
+    def connection(self, timeout=-1):
+        """with 块里抛出异常时连接可能处于未知状态(如事务没结束), 关闭而不归还
+        """
+        entry = self.checkout(timeout)
+        try:
+            yield entry[0]
+        except:
+            self.discard(entry)
+            raise
+        self.checkin(entry)
+
+
+def test_benchmark_steal(n=8, tasks=400):
+    """偏斜任务(每20个有1个慢任务)下, 普通模式和 work stealing 模式的任务延迟(提交到完成)对比
+    """
+    def task(i, t0):
+        time.sleep(0.2 if i % 20 == 0 else 0.005)
+        return time.time() - t0
+
+    for steal in (False, True):
+        pool = Pool(n, steal=steal)
+        t0 = time.time()
+        deferred_lst = [pool.spawn(task, args=(i, time.time()), deferred=True) for i in xrange(tasks)]
+        latencies = sorted(d.get() for d in deferred_lst)
+        print 'steal' if steal else 'plain', 'total: %.3fs' % (time.time() - t0), \
+            'p50: %.3fs' % latencies[len(latencies) / 2], 'p99: %.3fs' % latencies[len(latencies) * 99 / 100], \
+            'max: %.3fs' % latencies[-1]
+
+
+def test_lanes():
+    """1个线程先被慢任务占住, 之后提交的任务按 priority 执行, 过期的任务被丢弃
+    """
+    pool = Pool(1, lanes=True)
+    pool.spawn(time.sleep, args=(0.2,))
+    order = []
+    deferred_lst = [pool.spawn(order.append, args=(p,), deferred=True, priority=p) for p in (2, 1, 0, 1)]
+    expired = pool.spawn(order.append, args=('expired',), deferred=True, deadline=time.time() + 0.1)
+    for d in deferred_lst:
+        d.get()
+    try:
+        expired.get()
+    except DeadlineExceeded as e:
+        print 'expired:', e
+    print order
+    print pool.lane_stats.snapshot()
+
 
 if __name__ == '__main__':
     import time
@@ -0,0 +1,282 @@
+# -*- coding: utf-8 -*-
+"""multiprocessing pool"""
+
+from itertools import count
+from Queue import Empty
+from threading import Lock, Thread
+import cPickle
+import logging
+import mmap
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+from event import AsyncResult
+
+logger = logging.getLogger(__name__)
+
+
+class SharedBytes(object):
+    """大的 str 参数写到共享内存文件(/dev/shm)里, 子进程 mmap 只读打开, 不经过 pickle
+    """
+
+    def __init__(self, data):
+        fd, self.path = tempfile.mkstemp(prefix='pu-', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        try:
+            os.write(fd, data)
+        finally:
+            os.close(fd)
+        self.size = len(data)
+
+    def open(self):
+        """子进程中调用
+        :return: 只读 mmap, 可以像 str 一样切片, len, re.search 等
+        """
+        if not self.size:
+            return ''
+        with open(self.path, 'rb') as f:
+            return mmap.mmap(f.fileno(), self.size, access=mmap.ACCESS_READ)
+
+    def unlink(self):
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+
+def dump_results(results):
+    """结果在子进程里先 pickle 好再放入 out, 不能 pickle 的结果换成异常, 避免整批结果丢失
+    """
+    try:
+        return cPickle.dumps(results, 2)
+    except Exception:
+        checked = []
+        for task_id, ok, rs in results:
+            try:
+                cPickle.dumps(rs, 2)
+            except Exception:
+                logger.error('result of task %s can not be pickled', task_id, exc_info=1)
+                ok, rs = False, Exception('result can not be pickled: %s' % str(sys.exc_info()[1]))
+            checked.append((task_id, ok, rs))
+        return cPickle.dumps(checked, 2)
+
+
+def worker(q, out):
+    """子进程循环, q 里每条消息是 pickle 好的一批 [(task_id, func, args, kwargs), ..], 结果也按批 pickle 后放入 out
+    """
+    while True:
+        data = q.get()
+        if data is None:
+            return
+        batch = cPickle.loads(data)
+        results = []
+        for task_id, func, args, kwargs in batch:
+            try:
+                args = [arg.open() if isinstance(arg, SharedBytes) else arg for arg in args]
+                results.append((task_id, True, func(*args, **kwargs)))
+            except Exception:
+                logger.error('[Last call]: %s %s', func, str(args)[:200], exc_info=1)
+                results.append((task_id, False, Exception(str(sys.exc_info()[1]))))
+        out.put(dump_results(results))
+
+
+class ProcessPool(object):
+    """每个进程使用1个队列的进程池, 接口和 pu.pool.Pool 一样, 用于 CPU 密集的任务
+    : func 和参数, 结果都要能被 pickle(func 需要是模块级函数), 任务或结果不能 pickle 时 deferred 抛出异常
+    : 子进程意外退出时, 分给它的未完成任务 deferred 抛出异常, 并重新启动一个子进程
+    """
+
+    def __init__(self, n=None, shm_threshold=None):
+        """
+        :param n: 进程数, 默认 CPU 核数
+        :param shm_threshold: str 参数超过多少字节时通过共享内存传递, None-不使用
+        """
+        n = n or multiprocessing.cpu_count()
+        self.shm_threshold = shm_threshold
+        self.queues = [None] * n
+        self.tasks = [None] * n
+        self.pending = [set() for _ in xrange(n)]  # 每个进程未完成的 task_id
+        self.results = {}  # task_id: (async_result, shared, 进程下标)
+        self.lock = Lock()
+        self.task_ids = count()
+        self.counter = count()
+        self.out = multiprocessing.Queue()
+        self.closed = False
+
+        for i in xrange(n):
+            self._start(i)
+
+        t = Thread(target=self.collect)
+        t.setDaemon(True)
+        t.start()
+
+    def _start(self, i):
+        """启动第 i 个子进程, 使用新的队列(旧队列里的任务已经按失败处理)
+        """
+        self.queues[i] = multiprocessing.Queue()
+        p = multiprocessing.Process(target=worker, args=(self.queues[i], self.out))
+        p.daemon = True  # 主进程退出子进程退出
+        p.start()
+        self.tasks[i] = p
+
+    def collect(self, check_interval=0.5):
+        last_check = time.time()
+        while True:
+            try:
+                self._finish(cPickle.loads(self.out.get(timeout=check_interval)))
+            except Empty:
+                pass
+            if time.time() - last_check >= check_interval:
+                last_check = time.time()
+                self._check_workers()
+
+    def _finish(self, results):
+        for task_id, ok, rs in results:
+            with self.lock:
+                entry = self.results.pop(task_id, None)
+                if entry is None:  # 进程退出时已经按失败处理了
+                    continue
+                async_result, shared, i = entry
+                self.pending[i].discard(task_id)
+            for arg in shared:
+                arg.unlink()
+            if async_result is None:
+                if not ok:
+                    logger.error(str(rs))
+            elif ok:
+                async_result.set(rs)
+            else:
+                async_result.set_exception(rs)
+
+    def _check_workers(self):
+        for i, p in enumerate(self.tasks):
+            if self.closed or p.is_alive():
+                continue
+            while True:  # 先处理它退出前已经放入 out 的结果
+                try:
+                    self._finish(cPickle.loads(self.out.get_nowait()))
+                except Empty:
+                    break
+            error = Exception('worker process %s exited with code %s' % (p.pid, p.exitcode))
+            logger.error(str(error))
+            with self.lock:
+                task_ids, self.pending[i] = self.pending[i], set()
+                self._start(i)
+            self._finish([(task_id, False, error) for task_id in task_ids])
+
+    def _task(self, func, args, kwargs, deferred):
+        shared = []
+        if self.shm_threshold is not None:
+            args = list(args)
+            for i, arg in enumerate(args):
+                if isinstance(arg, str) and len(arg) >= self.shm_threshold:
+                    args[i] = SharedBytes(arg)
+                    shared.append(args[i])
+        task_id = next(self.task_ids)
+        async_result = AsyncResult() if deferred else None
+        return (task_id, func, args, kwargs), async_result, shared
+
+    def _selectq(self, qid=-1):
+        """选择第几个队列, 默认轮询(multiprocessing.Queue 的 qsize 不可靠)
+        :return: 队列下标
+        """
+        if qid >= 0:
+            return qid
+        return next(self.counter) % len(self.queues)
+
+    def _put(self, i, batch):
+        """在这里 pickle 任务, 不能 pickle 的任务直接失败(否则 Queue 的后台线程只打日志, 任务永远不会完成)
+        :param batch: [(task, async_result, shared), ..]
+        """
+        try:
+            data = cPickle.dumps([task for task, _, _ in batch], 2)
+        except Exception:
+            checked = []
+            for task, async_result, shared in batch:
+                try:
+                    cPickle.dumps(task, 2)
+                except Exception:
+                    logger.error('task %s can not be pickled: %s', task[0], task[1], exc_info=1)
+                    error = Exception('task can not be pickled: %s' % str(sys.exc_info()[1]))
+                    for arg in shared:
+                        arg.unlink()
+                    if async_result is not None:
+                        async_result.set_exception(error)
+                    continue
+                checked.append((task, async_result, shared))
+            if not checked:
+                return
+            batch = checked
+            data = cPickle.dumps([task for task, _, _ in batch], 2)
+        with self.lock:
+            for task, async_result, shared in batch:
+                self.results[task[0]] = (async_result, shared, i)
+                self.pending[i].add(task[0])
+            self.queues[i].put(data)
+
+    def spawn(self, func, args=tuple(), kwargs={}, qid=-1, deferred=False):
+        """
+        :param deferred: 是否返回deferred
+        :return: 如果deferred是True, 返回deferred, False返回None
+        """
+        task, async_result, shared = self._task(func, args, kwargs, deferred)
+        self._put(self._selectq(qid), [(task, async_result, shared)])
+        return async_result
+
+    def map(self, func, args_kwargs_lst=[], qid=-1, deferred=True, timeout=None, chunksize=None):
+        """并发map, 参数按 chunksize 分批, 一批只 pickle 和发送一次
+        :param args_kwargs_lst: args kwargs list => [(args, kwargs), ..] eg. [((2,3), {2:4}), ...]
+        :param chunksize: 每批的任务数, 默认平均分给每个进程
+        :return 返回结果 generator
+        """
+        args_kwargs_lst = list(args_kwargs_lst)
+        chunksize = chunksize or max(1, len(args_kwargs_lst) / len(self.queues))
+        deferred_lst = []
+        for i in xrange(0, len(args_kwargs_lst), chunksize):
+            batch = [self._task(func, args, kwargs or {}, True) for args, kwargs in args_kwargs_lst[i:i + chunksize]]
+            deferred_lst.extend(async_result for _, async_result, _ in batch)
+            self._put(self._selectq(qid), batch)
+        return (d.get(timeout=timeout) for d in deferred_lst)
+
+    def close(self):
+        self.closed = True
+        for q in self.queues:
+            q.put(None)
+        for p in self.tasks:
+            p.join()
+
+
+def _test_square(x):
+    return x * x
+
+
+def _test_find(data, sub):
+    return data.find(sub)
+
+
+def _test_generator(n):
+    return (i for i in xrange(n))
+
+
+def _test_exit(code):
+    os._exit(code)
+
+
+def test_process_pool():
+    pool = ProcessPool(4, shm_threshold=1024 * 1024)
+    print list(pool.map(_test_square, [((i,), {}) for i in xrange(10)]))
+    print pool.spawn(_test_find, args=('x' * 10 * 1024 * 1024 + 'y', 'y'), deferred=True).get()
+    print pool.spawn(_test_square, args=(3,), qid=1, deferred=True).get()
+    for func, arg in ((_test_generator, 3), (_test_exit, 1), (_test_square, _test_generator(1))):  # 结果/参数不能 pickle, 子进程退出
+        try:
+            pool.spawn(func, args=(arg,), qid=0, deferred=True).get(timeout=5)
+        except Exception as e:
+            print func.__name__, repr(e)
+    print pool.spawn(_test_square, args=(4,), qid=0, deferred=True).get()
+    pool.close()
+
+
+if __name__ == '__main__':
+    test_process_pool()
@@ -5,4 +5,5 @@
 sqlite db utils
 """
 
-from client import Sqlite3Connection
\ No newline at end of file
+from client import Sqlite3Connection
+from pool import Sqlite3Pool
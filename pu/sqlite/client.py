@@ -5,12 +5,22 @@
 sqlite3 db client
 """
 
-from StringIO import StringIO
+from collections import OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from itertools import chain, islice
+from threading import Event, Lock, RLock, Thread, current_thread
 import logging
+import re
+import sys
 import sqlite3
 import os
 import time
 
+from ..columnar import fetch_columns
+from ..datatype import compact_row_class
+from ..instrument import Histogram, rows_size
+
 logger = logging.getLogger(__name__)
 
 
@@ -24,60 +34,502 @@ class Row(dict):
             raise AttributeError(name)
 
 
+_RE_WORD = re.compile(r'\w+')
+_RE_NOT_WRITE = re.compile(r'^\s*(?:select|explain|pragma)\b', re.I)
+_RE_NO_COMMIT = re.compile(r'^\s*(?:select|insert|update|delete|replace)\b', re.I)  # python2 sqlite3 执行其它语句前会先 commit
+_RE_DDL = re.compile(r'^\s*(?:create|drop|alter|attach|detach|vacuum)\b', re.I)
+
+
+class TransactionError(Exception):
+    pass
+
+
+class ResultCache(object):
+    """查询结果缓存, key 是 (sql, args), LRU + ttl 淘汰, 按表失效
+    : 多个连接可以共用一个(如 Sqlite3Pool 的读连接和写连接), 线程安全
+    : 每个表有版本号, 失效时加1; 查询前取版本号, 查询期间表被失效过则不缓存结果, 避免缓存在失效之前读到的旧数据
+    """
+
+    def __init__(self, size=1000, ttl=None, max_rows=1000):
+        """
+        :param size: 最多缓存的结果数
+        :param ttl: 结果缓存多少秒, None-直到被淘汰或失效
+        :param max_rows: 超过这个行数的结果不缓存
+        """
+        self.size = size
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.lock = Lock()
+        self.entries = OrderedDict()  # key: (rows, tables, expire)
+        self.tables = {}  # table: set(key)
+        self.generation = 0  # 每次 ddl 加1, 连接据此刷新表名
+        self.versions = {}  # table: 失效次数
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        :return: rows, 没有缓存时返回 None
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[2] is not None and time.time() > entry[2]:
+                self._unlink(key, entry[1])
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def version(self, tables):
+        """查询前调用, 结果传给 put
+        """
+        with self.lock:
+            return self.generation, tuple(self.versions.get(table, 0) for table in tables)
+
+    def put(self, key, rows, tables, version):
+        """
+        :param tables: 查询用到的表, 为空时不缓存(不知道什么时候失效)
+        :param version: 查询前 version(tables) 的返回值
+        """
+        if not tables or len(rows) > self.max_rows:
+            return
+        with self.lock:
+            if version != (self.generation, tuple(self.versions.get(table, 0) for table in tables)):
+                return
+            if key in self.entries:
+                self._unlink(key, self.entries.pop(key)[1])
+            while len(self.entries) >= self.size:
+                old_key, (_, old_tables, _) = self.entries.popitem(last=False)
+                self._unlink(old_key, old_tables)
+            self.entries[key] = (tuple(rows), tables, time.time() + self.ttl if self.ttl is not None else None)
+            for table in tables:
+                self.tables.setdefault(table, set()).add(key)
+
+    def _unlink(self, key, tables):
+        for table in tables:
+            keys = self.tables.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.tables[table]
+
+    def invalidate(self, tables=None):
+        """
+        :param tables: 失效这些表相关的结果, None-全部失效(ddl)
+        """
+        with self.lock:
+            if tables is None:
+                self.invalidations += len(self.entries)
+                self.entries.clear()
+                self.tables.clear()
+                self.generation += 1
+                return
+            for table in tables:
+                self.versions[table] = self.versions.get(table, 0) + 1
+                for key in self.tables.pop(table, ()):
+                    entry = self.entries.pop(key, None)
+                    if entry is not None:
+                        self._unlink(key, entry[1])
+                        self.invalidations += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return dict(size=len(self.entries), capacity=self.size, hits=self.hits, misses=self.misses,
+                    invalidations=self.invalidations, hit_rate=total and float(self.hits) / total or 0.0)
+
+
+PRAGMA_PROFILES = {
+    'default': [],
+    # 读多写少的服务: wal 模式读写互不阻塞, synchronous=NORMAL 在 wal 下只在 checkpoint 时 fsync
+    'wal': [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('temp_store', 'MEMORY'),
+            ('cache_size', -64 * 1024), ('mmap_size', 256 * 1024 * 1024)],
+    'read_heavy': [('journal_mode', 'WAL'), ('synchronous', 'NORMAL'), ('temp_store', 'MEMORY'),
+                   ('cache_size', -256 * 1024), ('mmap_size', 1024 * 1024 * 1024)],
+    # 批量导入, 崩溃可能丢数据
+    'bulk': [('journal_mode', 'WAL'), ('synchronous', 'OFF'), ('temp_store', 'MEMORY'),
+             ('cache_size', -256 * 1024)],
+}
+
+
+def apply_pragmas(conn, pragmas):
+    """
+    :param pragmas: PRAGMA_PROFILES 里的名字, 或 [(name, value), ..], 或 dict
+    """
+    if isinstance(pragmas, basestring):
+        pragmas = PRAGMA_PROFILES[pragmas]
+    elif isinstance(pragmas, dict):
+        pragmas = pragmas.items()
+    for name, value in pragmas:
+        conn.execute('PRAGMA %s=%s' % (name, value)).fetchall()
+
+
+def attach_copy(conn, database):
+    """把文件db按表复制到 conn 的 main 库: 先建表导数据, 再建索引/视图/触发器
+    : python2 的 sqlite3 模块没有 backup api, 用 attach + insert select 代替
+    """
+    conn.execute('ATTACH DATABASE ? AS src', (database,))
+    try:
+        objects = conn.execute("select type, name, sql from src.sqlite_master where sql is not null "
+                               "order by case type when 'table' then 0 else 1 end").fetchall()
+        for type_, name, sql in objects:
+            if name.startswith('sqlite_'):
+                continue
+            conn.execute(sql)
+            if type_ == 'table':
+                conn.execute('INSERT INTO main."%s" SELECT * FROM src."%s"' % (name, name))
+        if any(name == 'sqlite_sequence' for _, name, _ in objects):  # 导数据时已经生成了 sqlite_sequence, 以原库为准
+            conn.execute('DELETE FROM main.sqlite_sequence')
+            conn.execute('INSERT INTO main.sqlite_sequence SELECT * FROM src.sqlite_sequence')
+        conn.commit()
+    finally:
+        conn.execute('DETACH DATABASE src')
+
+
+def locked(func):
+    @wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+
+def fsync_file(path):
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 class Sqlite3Connection(object):
-    def __init__(self, memorize=False, **kwargs):
+    def __init__(self, memorize=False, row_factory=None, instrument=None, flush_interval=None,
+                 flush_writes=None, pragmas=None, readonly=False, check_same_thread=True, result_cache=None,
+                 result_cache_ttl=None, **kwargs):
         """
-        :param memorize: True-把db文件加载到内存,***而且此时向数据库写并不会同步到文件中***
+        :param memorize: True-把db文件加载到内存, 写操作只在内存中, 调用 flush/checkpoint 才写回文件
+        :param row_factory: 行类型, None-Row(dict), 'compact'-基于 tuple 的 CompactRow(省内存, 构造快)
+        :param instrument: pu.instrument.Instrument, 查询钩子
+        :param flush_interval: memorize 模式下后台线程每隔多少秒写回文件(有写操作时), None-不定时写回
+        :param flush_writes: memorize 模式下每 execute/executemany 多少次后台写回文件, None-不按次数写回
+            : 后台只写回已提交的数据(auto_commit=True 或 commit() 之后), 有未提交的写时跳过这次写回, 不会替调用方提交
+            : 写回是一次 VACUUM INTO, 期间这个连接上的读写会等待
+        :param pragmas: 连接后执行的 pragma, PRAGMA_PROFILES 里的名字(如 'wal') 或 [(name, value), ..]
+        :param readonly: True-只读连接(PRAGMA query_only)
+        :param check_same_thread: False-允许在其它线程使用连接, 调用方保证同一时间只有一个线程使用
+        :param result_cache: fetchall/fetchone 结果缓存的大小, 或 ResultCache 对象(多个连接共用), None-不缓存
+            : 通过本连接(或共用缓存的连接) execute/executemany 写表时自动失效, 其它进程写入不会失效
+            : 事务中或有未提交的写时不使用缓存; 命中时返回缓存的行对象, 不要修改
+        :param result_cache_ttl: 结果缓存多少秒, None-不过期
         :param database(或db): 数据库文件,:memory:表示存储在内存中
         """
+        self.row_factory = row_factory
+        self.instrument = instrument
         self.database = kwargs.get('database') or kwargs.get('db')
         self.memorize = memorize
+        self.pragmas = pragmas
+        self.readonly = readonly
+        self.check_same_thread = check_same_thread
+        self.in_transaction = False
+        self.transaction_tables = set()  # 事务中或未提交时写过的表, commit/rollback 时再失效一次, None-所有表
+        if isinstance(result_cache, (int, long)):
+            result_cache = ResultCache(result_cache, result_cache_ttl)
+        self.result_cache = result_cache
+        self.schema = None  # (generation, 表名 set, 视图名 set, 是否有触发器)
+        self.flush_interval = flush_interval
+        self.flush_writes = flush_writes
+        self.write_back = memorize and bool(flush_interval or flush_writes)
+        self.writes = 0  # 上次写回之后的写操作数
+        self.lock = RLock()  # 连接的所有操作都加锁, 和后台写回线程互斥
+        self.committed_changes = 0  # 上次提交时的 conn.total_changes, 不相等说明有未提交的写
+        self.flush_histogram = Histogram()  # 每次写回的耗时
+        self.flush_event = Event()
+        self.write_back_thread = None
 
         if self.memorize:
             self.load()
         else:
-            self.conn = sqlite3.connect(self.database)
+            self.connect()
+        self._start_write_back()
+
+    def _start_write_back(self):
+        if self.write_back:
+            self.flush_event.clear()
+            self.write_back_thread = Thread(target=self.write_back_loop)
+            self.write_back_thread.setDaemon(True)
+            self.write_back_thread.start()
+
+    def connect(self):
+        self.conn = sqlite3.connect(self.database, check_same_thread=self.check_same_thread)
+        if self.pragmas:
+            apply_pragmas(self.conn, self.pragmas)
+        if self.readonly:
+            self.conn.execute('PRAGMA query_only=1')
+        self.committed_changes = self.conn.total_changes
 
     def load(self):
-        """把文件db load到内存
+        """把文件db load到内存, 用 attach_copy 按表复制, 不生成 sql 文本
+        """
+        # 后台线程要写回
+        self.conn = sqlite3.connect(':memory:', check_same_thread=self.check_same_thread and not self.write_back)
+        attach_copy(self.conn, self.database)
+        if self.pragmas:
+            apply_pragmas(self.conn, self.pragmas)
+        if self.readonly:
+            self.conn.execute('PRAGMA query_only=1')
+        self.committed_changes = self.conn.total_changes
+
+    def flush(self):
+        """commit 后把内存db写回文件: 先 VACUUM INTO(sqlite 3.27+) 到 database.tmp 并 fsync, 再 rename 覆盖原文件,
+        : 中途崩溃原文件不受影响. VACUUM INTO 是一次完成的, 执行期间这个连接上的其它读写会等待
+        : 非 memorize 模式只 commit
+        :return: 写回耗时(秒)
+        """
+        with self.lock:
+            start = time.time()
+            self.commit()
+            if not self.memorize:
+                return time.time() - start
+            return self._write_back(start)
+
+    def _write_back(self, start):
+        """调用方持有 self.lock, 并且没有未提交的写
+        """
+        self.writes = 0
+        tmp = '%s.tmp' % self.database
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        self.conn.execute('VACUUM INTO ?', (tmp,))
+        fsync_file(tmp)
+        os.rename(tmp, self.database)
+        elapsed = time.time() - start
+        self.flush_histogram.add(elapsed)
+        logger.debug('flush %s in %.3fs', self.database, elapsed)
+        return elapsed
+
+    def _uncommitted(self):
+        return self.conn.total_changes != self.committed_changes
+
+    def flush_stats(self):
+        """
+        :return: 写回耗时统计 {count, total, avg, max, p50, p90, p99} 和未写回的写操作数 pending_writes
+        """
+        stats = self.flush_histogram.snapshot()
+        stats['pending_writes'] = self.writes
+        return stats
+
+    def write_back_loop(self):
+        while self.write_back:
+            self.flush_event.wait(self.flush_interval)
+            self.flush_event.clear()
+            with self.lock:  # transaction() 持有锁, 所以这里不会在事务中间
+                if not self.write_back or not self.writes or self._uncommitted():
+                    continue
+                try:
+                    self._write_back(time.time())
+                except Exception:
+                    logger.error('write back %s except', self.database, exc_info=1)
+
+    def _written(self, query):
+        if self.result_cache is not None:
+            tables = self._written_tables(query)
+            if tables is not False:
+                if self.in_transaction or self._uncommitted():
+                    if tables is None or self.transaction_tables is None:
+                        self.transaction_tables = None
+                    else:
+                        self.transaction_tables.update(tables)
+                self.result_cache.invalidate(tables)
+        if self.memorize:
+            self.writes += 1
+            if self.flush_writes and self.writes >= self.flush_writes:
+                self.flush_event.set()
+
+    def _schema(self):
+        generation = self.result_cache.generation
+        if self.schema is None or self.schema[0] != generation:
+            tables, views, triggers = set(), set(), False
+            for type_, name in self.conn.execute('select type, lower(name) from sqlite_master'):
+                if type_ == 'table':
+                    tables.add(name)
+                elif type_ == 'view':
+                    views.add(name)
+                elif type_ == 'trigger':
+                    triggers = True
+            self.schema = generation, tables, views, triggers
+        return self.schema
+
+    def _read_tables(self, query):
+        """查询用到的表: sql 里出现的表名(可能多算, 不会少算), 用到视图时算所有表
+        """
+        _, tables, views, _ = self._schema()
+        words = set(_RE_WORD.findall(query.lower()))
+        if words & views:
+            return tables
+        return words & tables
+
+    def _written_tables(self, query):
+        """
+        :return: 写语句影响的表, False-不是写语句, None-ddl 或有触发器, 所有表都可能受影响
+        """
+        if _RE_NOT_WRITE.match(query):
+            return False
+        if _RE_DDL.match(query):
+            return None
+        _, tables, _, triggers = self._schema()
+        if triggers:
+            return None
+        return set(_RE_WORD.findall(query.lower())) & tables
+
+    def result_cache_stats(self):
+        """
+        :return: 结果缓存命中统计, None-没有开启缓存
+        """
+        if self.result_cache is None:
+            return None
+        return self.result_cache.stats()
+
+    def checkpoint(self, mode='PASSIVE'):
+        """memorize 模式写回文件, 否则 commit 后执行 wal checkpoint(非 wal 模式时无作用)
+        :param mode: PASSIVE/FULL/RESTART/TRUNCATE
         """
-        _conn = sqlite3.connect(self.database)
-        str_buffer = StringIO()
-        for line in _conn.iterdump():
-            str_buffer.write('%s\n' % line)
-        self.conn = sqlite3.connect(':memory:')
-        self.conn.executescript(str_buffer.getvalue())
-        _conn.close()
+        if self.memorize:
+            return self.flush()
+        with self.lock:
+            self.commit()
+            return self.conn.execute('PRAGMA wal_checkpoint(%s)' % mode).fetchone()
 
     def dump(self):
-        """把内存db dump到文件
-        : 暂时不再使用
+        """把内存db dump到文件, 同 flush
         """
-        os.unlink(self.database)
-        _conn = sqlite3.connect(self.database)
-        str_buffer = StringIO()
-        for line in self.conn.iterdump():
-            str_buffer.write('%s\n' % line)
-        _conn.executescript(str_buffer.getvalue())
-        _conn.close()
+        return self.flush()
 
     def reload(self):
-        """重新加载
+        """重新加载, 后台写回线程在 close 时停止, 加载后重新启动
         """
         self.close()
+        self.write_back = self.memorize and bool(self.flush_interval or self.flush_writes)
         if self.memorize:
             self.load()
         else:
-            self.conn = sqlite3.connect(self.database)
+            self.connect()
+        self._start_write_back()
+        if self.result_cache is not None:
+            self.result_cache.invalidate()
 
     def close(self):
-        try:
-            self.conn.close()
-        finally:
-            logger.info('connection closed')
+        if self.write_back:  # 停止后台写回, 把剩下已提交的写操作写回文件, 未提交的和普通 sqlite 连接一样丢弃
+            self.write_back = False
+            self.flush_event.set()
+            if self.write_back_thread is not current_thread():
+                self.write_back_thread.join()
+            with self.lock:
+                if self.writes and not self._uncommitted():
+                    self._write_back(time.time())
+        with self.lock:
+            try:
+                self.conn.close()
+            finally:
+                logger.info('connection closed')
 
     def commit(self):
-        self.conn.commit()
+        with self.lock:
+            self.conn.commit()
+            self.committed_changes = self.conn.total_changes
+            self._invalidate_transaction_tables()
+            if self.write_back and self.flush_writes and self.writes >= self.flush_writes:
+                self.flush_event.set()
+
+    def rollback(self):
+        with self.lock:
+            self.conn.rollback()
+            self.committed_changes = self.conn.total_changes
+            self._invalidate_transaction_tables()
+
+    def _invalidate_transaction_tables(self):
+        """提交前其它连接可能又缓存了旧数据, 回滚后缓存里可能有未提交的数据, 都要再失效一次
+        """
+        if self.result_cache is not None and self.transaction_tables != set():
+            self.result_cache.invalidate(self.transaction_tables)
+        self.transaction_tables = set()
+
+    @contextmanager
+    def transaction(self):
+        """事务, 正常退出 commit, 异常退出 rollback, 事务中 auto_commit 不生效
+        : sqlite3 模块在第一条 insert/update/delete 前自动 begin, 但执行 create/drop 等语句前会先 commit
+        : 嵌套时内层并入外层事务
+        example:
+            with conn.transaction():
+                conn.execute(...)
+        """
+        with self.lock:
+            if self.in_transaction:
+                yield self
+                return
+            self.commit()
+            self.in_transaction = True
+            try:
+                yield self
+                self.commit()
+            except:
+                exc_info = sys.exc_info()
+                try:
+                    self.rollback()
+                except:
+                    logger.error('rollback except', exc_info=1)
+                raise exc_info[0], exc_info[1], exc_info[2]
+            finally:
+                self.in_transaction = False
+
+    @locked
+    def bulk_load(self, table, rows, batch_size=10000, columns=None, rebuild_indexes=False):
+        """批量导入, 每 batch_size 行一个事务, 用 executemany 插入, rows 可以是 generator
+        : 在 transaction() 中调用时并入外层事务, 由外层 commit/rollback
+        :param table: 表名
+        :param rows: 行序列 [(v1, v2, ..), ..]
+        :param columns: 列名 list, None-按表的列顺序
+        :param rebuild_indexes: True-导入前删除表的索引, 导入后重建(大量导入时更快), 不能在事务中使用(ddl 会提交事务)
+        :return: 导入行数
+        """
+        if rebuild_indexes and self.in_transaction:
+            raise TransactionError('rebuild_indexes can not be used in transaction')
+        rows = iter(rows)
+        first = next(rows, None)
+        if first is None:
+            return 0
+        rows = chain([first], rows)
+        query = 'INSERT INTO %s%s VALUES (%s)' % (table, ' (%s)' % ', '.join(columns) if columns else '',
+                                                  ', '.join(['?'] * len(first)))
+        indexes = []
+        if rebuild_indexes:
+            indexes = self.conn.execute("select name, sql from sqlite_master where type='index' and tbl_name=? "
+                                        "and sql is not null", (table,)).fetchall()
+            for name, _ in indexes:
+                self.conn.execute('DROP INDEX "%s"' % name)
+            self.commit()
+        total = 0
+        try:
+            while True:
+                batch = list(islice(rows, batch_size))
+                if not batch:
+                    break
+                start = self.instrument and self.instrument.before(query)
+                with self.transaction():
+                    self.conn.executemany(query, batch)
+                if start:
+                    self.instrument.after(query, start, len(batch))
+                self._written(query)
+                total += len(batch)
+                logger.debug('bulk load %s: %d rows', table, total)
+        finally:
+            for _, sql in indexes:
+                self.conn.execute(sql)
+            if not self.in_transaction:
+                self.commit()
+        return total
 
     def execute(self, query, *args, **kwargs):
         """
@@ -85,23 +537,69 @@ class Sqlite3Connection(object):
         """
         return self._execute_lastrowid(query, *args, **kwargs)
 
+    @locked
     def _execute_lastrowid(self, query, *args, **kwargs):
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._execute(query, args, kwargs)
             if result is False:
                 return False
+            self._written(query)
+            if start:
+                self.instrument.after(query, start, cursor.rowcount)
             return cursor.lastrowid
         finally:
             if locals().get('cursor'):
                 cursor.close()
 
+    @locked
     def fetchall(self, query, *args, **kwargs):
+        key = None
+        # 事务中或有未提交的写时不读也不写缓存, 这时的结果可能回滚, 也可能和其它连接看到的不一样
+        if self.result_cache is not None and not self.in_transaction and not self._uncommitted():
+            key = (query, args)
+            try:
+                rows = self.result_cache.get(key)
+            except TypeError:  # args 不能 hash
+                key = rows = None
+            if rows is not None:
+                return list(rows)
+            if key is not None:
+                tables = tuple(self._read_tables(query))
+                version = self.result_cache.version(tables)
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._execute(query, args, kwargs)
             column_names = [d[0] for d in cursor.description]
             if result is False:
                 return False
-            return [Row(zip(column_names, row)) for row in cursor]
+            if self.row_factory == 'compact':
+                row_cls = compact_row_class(column_names)
+                rows = [row_cls(row) for row in cursor]
+            else:
+                rows = [Row(zip(column_names, row)) for row in cursor]
+            if start:
+                self.instrument.after(query, start, len(rows), rows_size(rows))
+            if key is not None:
+                self.result_cache.put(key, rows, tables, version)
+            return rows
+        finally:
+            if locals().get('cursor'):
+                cursor.close()
+
+    @locked
+    def fetch_columns(self, query, *args, **kwargs):
+        """按列返回结果, 分批 fetchmany, 不构造每行的 Row
+        : sqlite 没有列类型信息, 按第一批的值确定类型
+        :param batch_size: 每批的行数, 默认1000
+        :return: 有 numpy 时 {column name: numpy array}, 否则 {column name: array.array 或 list}
+        """
+        batch_size = kwargs.pop('batch_size', 1000)
+        try:
+            result, cursor = self._execute(query, args, kwargs)
+            if result is False:
+                return False
+            return fetch_columns(cursor, batch_size)
         finally:
             if locals().get('cursor'):
                 cursor.close()
@@ -130,11 +628,16 @@ class Sqlite3Connection(object):
         """
         return self._executemany_lastrowid(query, args, kwargs)
 
+    @locked
     def _executemany_lastrowid(self, query, args, kwargs):
+        start = self.instrument and self.instrument.before(query)
         try:
             result, cursor = self._executemany(query, args, kwargs)
             if result is False:
                 return False
+            self._written(query)
+            if start:
+                self.instrument.after(query, start, cursor.rowcount)
             return cursor.lastrowid
         finally:
             if locals().get('cursor'):
@@ -148,8 +651,10 @@ class Sqlite3Connection(object):
         cursor = self.conn.cursor()
         logger.debug('sql: %s, args: %s', query, str(args))
         ret = [cursor.execute(query, args), cursor]
-        if auto_commit:
+        if auto_commit and not self.in_transaction:
             self.commit()
+        elif not _RE_NO_COMMIT.match(query):
+            self.committed_changes = self.conn.total_changes
         return ret
 
     def _executemany(self, query, args, kwargs):
@@ -160,10 +665,13 @@ class Sqlite3Connection(object):
         cursor = self.conn.cursor()
         logger.debug('sql: %s, args: %s', query, str(args))
         ret = [cursor.executemany(query, args), cursor]
-        if auto_commit:
+        if auto_commit and not self.in_transaction:
             self.commit()
+        elif not _RE_NO_COMMIT.match(query):
+            self.committed_changes = self.conn.total_changes
         return ret
 
+    @locked
     def get_fields(self, table_name):
         result, cursor = self._execute('select * from %s limit 0' % table_name, tuple(), {})
         if result is False:
@@ -201,11 +709,46 @@ def test_client():
     conn3.execute('insert into book values("abc", ?)', 'yyyy', auto_commit=False)
 
 
+def test_benchmark_bulk_load(n=20000):
+    """逐行 execute(auto_commit) 和 bulk_load 的导入速度对比
+    """
+    if os.path.exists('bulk.db'):
+        os.unlink('bulk.db')
+    c = Sqlite3Connection(database='bulk.db')
+    c.execute('create table book (id integer, name varchar(50), author varchar(50))')
+    c.execute('create index book_author on book (author)')
+
+    t0 = time.time()
+    for i in xrange(n / 10):
+        c.execute('insert into book values (?, ?, ?)', i, 'name%d' % i, 'author%d' % (i % 100), auto_commit=True)
+    print 'row at a time: %.0f rows/s' % (n / 10 / (time.time() - t0))
+
+    t0 = time.time()
+    rows = ((i, 'name%d' % i, 'author%d' % (i % 100)) for i in xrange(n))
+    c.bulk_load('book', rows, rebuild_indexes=True)
+    print 'bulk load: %.0f rows/s' % (n / (time.time() - t0))
+    c.close()
+    os.unlink('bulk.db')
+
+
 def test_memorize():
     logging.basicConfig(level=logging.DEBUG, format='[%(asctime)-15s %(levelname)s:%(module)s] %(message)s')
     c = Sqlite3Connection(database='x.db', memorize=True)
-    c.execute('insert into book values("abc", ?)', 'xxxx')  # 不会同步到磁盘,只在内存中
+    c.execute('insert into book values("abc", ?)', 'xxxx')  # 只在内存中
     print c.fetchall('select * from book')
+    print 'flush: %.3fs' % c.flush()  # 写回磁盘
+
+
+def test_write_back():
+    """每 0.5 秒或每 100 次写操作后台写回
+    """
+    c = Sqlite3Connection(database='x.db', memorize=True, flush_interval=0.5, flush_writes=100)
+    for i in xrange(1000):
+        c.execute('insert into book values(?, ?)', 'name%d' % i, 'write_back', auto_commit=True)  # 只写回已提交的
+    time.sleep(1)
+    print c.flush_stats()
+    c.close()
+    print Sqlite3Connection(database='x.db').fetchone('select count(*) n from book where author="write_back"')
 
 
 def test_benchmark():
@@ -214,3 +757,38 @@ def test_benchmark():
     [c.fetchone('select * from book where author="zhangsan"') for _ in xrange(10000)]
     print 10000 / (time.time() - t0), 'qps'
     c.close()
+
+
+def test_benchmark_result_cache(n=10000):
+    """同一个 fetchone 执行 n 次, 有无结果缓存的 qps 对比
+    """
+    for result_cache in (None, 100):
+        c = Sqlite3Connection(database=':memory:', result_cache=result_cache)
+        c.execute('create table book (name varchar(50), author varchar(50))')
+        c.executemany('insert into book values (?, ?)', [('name%d' % i, 'author%d' % (i % 100)) for i in xrange(1000)])
+        t0 = time.time()
+        [c.fetchone('select * from book where name=?', 'name1') for _ in xrange(n)]
+        print 'cache' if result_cache else 'no cache', '%.0f qps' % (n / (time.time() - t0)), c.result_cache_stats()
+        c.close()
+
+
+def test_benchmark_row_factory(n=100000):
+    """Row(dict) 和 CompactRow 的构造时间/内存对比
+    """
+    import gc
+    import sys
+
+    c = Sqlite3Connection(database=':memory:')
+    c.execute('create table book (id integer, name varchar(50), author varchar(50), price real)')
+    c.executemany('insert into book values (?, ?, ?, ?)', [(i, 'name%d' % i, 'author%d' % i, i * 0.5)
+                                                            for i in xrange(n)])
+    for row_factory in (None, 'compact'):
+        c.row_factory = row_factory
+        gc.collect()
+        t0 = time.time()
+        rows = c.fetchall('select * from book')
+        elapsed = time.time() - t0
+        size = sum(sys.getsizeof(row) for row in rows)
+        print row_factory or 'dict', '%.3fs' % elapsed, '%.1fMB' % (size / 1024.0 / 1024), rows[-1].name
+        del rows
+    c.close()
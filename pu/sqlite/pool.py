@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+""" description
+sqlite 多读单写连接池
+"""
+
+from contextlib import contextmanager
+from Queue import Queue
+from threading import Lock
+import logging
+
+from client import ResultCache, Sqlite3Connection
+
+logger = logging.getLogger(__name__)
+
+
+class Sqlite3Pool(object):
+    """线程安全的 sqlite 连接池: n 个只读连接并发读, 1 个写连接串行写, 方法和 Sqlite3Connection 一致
+    : 需要 wal 模式(默认 pragmas='wal'), 读写互不阻塞; 只能用于文件db, 不能是 :memory: 或 memorize
+    example:
+        pool = Sqlite3Pool(4, database='x.db')
+        pool.execute('insert into book values(?, ?)', 'a', 'zhangsan')  # 默认 auto_commit
+        pool.fetchall('select * from book')  # 在任意线程调用
+    """
+
+    def __init__(self, n=4, pragmas='wal', **kwargs):
+        """
+        :param n: 只读连接数
+        :param pragmas: 见 Sqlite3Connection
+        :param kwargs: Sqlite3Connection 的其它参数, 如 database, row_factory, instrument, result_cache
+            : result_cache 由所有连接共用, 写连接写表时读连接的缓存也会失效
+        """
+        assert not kwargs.get('memorize')
+        if isinstance(kwargs.get('result_cache'), (int, long)):
+            kwargs['result_cache'] = ResultCache(kwargs['result_cache'], kwargs.pop('result_cache_ttl', None))
+        self.writer = Sqlite3Connection(pragmas=pragmas, check_same_thread=False, **kwargs)
+        assert self.writer.database != ':memory:'
+        self.write_lock = Lock()
+        self.readers = Queue()
+        for _ in xrange(n):
+            self.readers.put(Sqlite3Connection(pragmas=pragmas, readonly=True, check_same_thread=False, **kwargs))
+        self.n = n
+
+    @contextmanager
+    def reader(self):
+        conn = self.readers.get()
+        try:
+            yield conn
+        finally:
+            self.readers.put(conn)
+
+    @contextmanager
+    def writing(self):
+        """在写连接上执行多条语句: with pool.writing() as conn: ..
+        """
+        with self.write_lock:
+            yield self.writer
+
+    def fetchall(self, query, *args, **kwargs):
+        with self.reader() as conn:
+            return conn.fetchall(query, *args, **kwargs)
+
+    def fetchone(self, query, *args, **kwargs):
+        with self.reader() as conn:
+            return conn.fetchone(query, *args, **kwargs)
+
+    def fetch_columns(self, query, *args, **kwargs):
+        with self.reader() as conn:
+            return conn.fetch_columns(query, *args, **kwargs)
+
+    def get_fields(self, table_name):
+        with self.reader() as conn:
+            return conn.get_fields(table_name)
+
+    def execute(self, query, *args, **kwargs):
+        """写完默认 commit, 否则读连接看不到
+        :return: lastrowid
+        """
+        kwargs.setdefault('auto_commit', True)
+        with self.write_lock:
+            return self.writer.execute(query, *args, **kwargs)
+
+    def executemany(self, query, args, kwargs={'auto_commit': True}):
+        with self.write_lock:
+            return self.writer.executemany(query, args, kwargs)
+
+    def commit(self):
+        with self.write_lock:
+            self.writer.commit()
+
+    def checkpoint(self, mode='PASSIVE'):
+        with self.write_lock:
+            return self.writer.checkpoint(mode)
+
+    def close(self):
+        for _ in xrange(self.n):
+            self.readers.get().close()
+        with self.write_lock:
+            self.writer.close()
+
+
+def test_pool(n=4, threads=8, queries=2000):
+    """多线程读, 同时一个线程写
+    """
+    from threading import Thread
+    import time
+
+    pool = Sqlite3Pool(n, database='x.db')
+    pool.execute('create table if not exists book (name varchar(50), author varchar(50))')
+
+    def read():
+        for _ in xrange(queries):
+            pool.fetchone('select count(*) n from book')
+
+    def write():
+        for i in xrange(queries / 10):
+            pool.execute('insert into book values(?, ?)', 'name%d' % i, 'pool')
+
+    t0 = time.time()
+    workers = [Thread(target=read) for _ in xrange(threads)] + [Thread(target=write)]
+    [t.start() for t in workers]
+    [t.join() for t in workers]
+    print threads * queries / (time.time() - t0), 'read qps', pool.fetchone('select count(*) n from book')
+    pool.close()